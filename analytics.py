@@ -0,0 +1,136 @@
+"""Per-battery charge time trends from the local charge history, all batteries at once.
+
+Everything is worked out with numpy over the whole cycles table in one go
+(grouped by tag with bincount/lexsort, no per battery python loop), so tens of
+thousands of cycles take milliseconds. Nothing here reads firebase.
+
+Per battery:
+    cycles          cycles counted (at least minTime)
+    mean_s, p10_s, p50_s, p90_s   charge time in seconds
+    drift_s_per_day least squares slope of charge time against date, + means it is taking longer to charge
+    cycles_per_day  cycles over the days between its first and last cycle (at least one day)
+    degrading       drift would add more than DEGRADE_FRACTION of its median charge time over DEGRADE_DAYS
+
+numpy is only needed for this, the station itself runs without it (pip install numpy).
+
+    python3 analytics.py [--db charge_history.db] [--days N] [--json]
+"""
+import argparse
+import json
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:  # optional, only the analytics need it
+    np = None
+
+from history import ChargeHistory
+
+HISTORY_FILE = "charge_history.db"
+MIN_CYCLES = 5          # fewer cycles than this and the drift is noise, never flagged
+DEGRADE_DAYS = 30       # the drift is judged over this many days
+DEGRADE_FRACTION = 0.05 # flagged if charge time grows more than 5% of the median over DEGRADE_DAYS
+DAY = 86400.0
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("analytics needs numpy, pip install numpy")
+
+
+def _grouped_percentile(sorted_values, offsets, counts, q):
+    """q-th percentile (0-100, linear interpolation) of every group in values sorted by group then value."""
+    pos = offsets + (q / 100.0) * (counts - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, offsets + counts - 1)
+    frac = pos - lo
+    return sorted_values[lo] * (1 - frac) + sorted_values[hi] * frac
+
+
+def battery_trends(tags, starts, durations, min_cycles=MIN_CYCLES):
+    """{tag: stats} for the given cycles (three equal length sequences, any order)."""
+    _require_numpy()
+    if len(tags) == 0:
+        return {}
+    names, codes = np.unique(np.asarray(tags), return_inverse=True)
+    starts = np.asarray(starts, dtype=np.float64)
+    durations = np.asarray(durations, dtype=np.float64)
+    k = len(names)
+
+    counts = np.bincount(codes, minlength=k)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    mean = np.bincount(codes, durations, minlength=k) / counts
+
+    # percentiles: sort by tag then duration, every tag is then one contiguous run
+    by_duration = durations[np.lexsort((durations, codes))]
+    p10, p50, p90 = (_grouped_percentile(by_duration, offsets, counts, q) for q in (10, 50, 90))
+
+    # drift: slope of duration against days, per tag. centred on each tag's mean so big epochs dont eat the precision
+    days = starts / DAY
+    mean_day = np.bincount(codes, days, minlength=k) / counts
+    dx = days - mean_day[codes]
+    dy = durations - mean[codes]
+    sxx = np.bincount(codes, dx * dx, minlength=k)
+    sxy = np.bincount(codes, dx * dy, minlength=k)
+    drift = np.divide(sxy, sxx, out=np.zeros(k), where=sxx > 0)
+
+    by_start = starts[np.argsort(codes, kind="stable")]
+    first = np.minimum.reduceat(by_start, offsets)
+    last = np.maximum.reduceat(by_start, offsets)
+    cycles_per_day = counts / np.maximum((last - first) / DAY, 1.0)
+
+    degrading = (counts >= min_cycles) & (drift * DEGRADE_DAYS > DEGRADE_FRACTION * p50)
+
+    return {
+        str(name): {
+            "cycles": int(counts[i]),
+            "mean_s": round(float(mean[i]), 1),
+            "p10_s": round(float(p10[i]), 1),
+            "p50_s": round(float(p50[i]), 1),
+            "p90_s": round(float(p90[i]), 1),
+            "drift_s_per_day": round(float(drift[i]), 2),
+            "cycles_per_day": round(float(cycles_per_day[i]), 2),
+            "first": float(first[i]),
+            "last": float(last[i]),
+            "degrading": bool(degrading[i]),
+        }
+        for i, name in enumerate(names)
+    }
+
+
+def load_trends(history, since=None, min_cycles=MIN_CYCLES):
+    """battery_trends() for every counted cycle in a ChargeHistory (optionally only ones that ended after `since`)."""
+    tags, starts, _, durations = history.columns(since=since)
+    return battery_trends(tags, starts, durations, min_cycles)
+
+
+def degrading(trends):
+    """Tags flagged as degrading, worst drift first."""
+    return sorted((tag for tag, t in trends.items() if t["degrading"]), key=lambda tag: -trends[tag]["drift_s_per_day"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Charge time trends per battery from the local charge history.")
+    parser.add_argument("--db", default=HISTORY_FILE)
+    parser.add_argument("--days", type=float, help="only cycles from the last N days")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    history = ChargeHistory(args.db)
+    since = time.time() - args.days * DAY if args.days else None
+    started = time.perf_counter()
+    trends = load_trends(history, since)
+    took = time.perf_counter() - started
+    if args.json:
+        print(json.dumps(trends))
+        return 0
+    print(f"{'tag':<12}{'cycles':>8}{'p50 s':>9}{'p90 s':>9}{'drift s/day':>13}{'cycles/day':>12}  degrading")
+    for tag, t in sorted(trends.items()):
+        print(f"{tag:<12}{t['cycles']:>8}{t['p50_s']:>9.0f}{t['p90_s']:>9.0f}{t['drift_s_per_day']:>13.2f}{t['cycles_per_day']:>12.2f}  {'YES' if t['degrading'] else ''}")
+    print(f"\n{sum(t['cycles'] for t in trends.values())} cycles, {len(trends)} batteries in {took * 1000:.1f}ms. degrading: {', '.join(degrading(trends)) or 'none'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""Read only HTTP + WebSocket API with the live station state, straight from memory.
+
+Dashboards and the naming frontend used to poll firebase for things the Pi
+already knows. LiveState holds them (slots, the next up pick, port health and
+the last few slot events) and serve() hands them out on the shop LAN:
+
+    GET /state               everything, {"seq": n, "state": {section: {key: value}}, "events": [...]}
+    GET /state/<section>     one section: slots, ports or station
+    GET /events              the last RECENT_EVENTS slot events
+    GET /ws                  WebSocket: a snapshot, then every change as it happens
+
+WebSocket messages are JSON text frames:
+
+    {"type": "snapshot", "seq": n, "state": {...}, "events": [...]}
+    {"type": "diff", "seq": n, "changes": {"slots/12": {...}, "station/nextup": null}}   new values, null = gone
+    {"type": "event", "seq": n, "event": {"kind": "start", "tag": ..., "slot": 12, ...}}
+
+Changes made in the same event loop pass go out as one diff. A client that
+falls too far behind gets a fresh snapshot instead of the backlog. seq goes up
+by one per message so a client can tell it missed something and re-fetch.
+
+Only standard library, like metrics.py. LiveState is only touched from the event loop thread, no locks.
+"""
+import asyncio
+import base64
+import copy
+import hashlib
+import json
+import logging
+from collections import deque
+
+general_log = logging.getLogger("GENERAL")
+
+RECENT_EVENTS = 50       # slot events kept for /events and the snapshot
+SUBSCRIBER_QUEUE = 256   # messages a WebSocket client can fall behind before it gets a snapshot instead
+MAX_CLIENT_FRAME = 65536 # we only expect pings and closes from clients
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class LiveState:
+    def __init__(self, recent=RECENT_EVENTS):
+        self.sections = {"slots": {}, "ports": {}, "station": {}}
+        self.events = deque(maxlen=recent)
+        self.seq = 0
+        self._pending = {}    # "section/key" -> new value, waiting for _flush
+        self._flush_scheduled = False
+        self._subscribers = set()
+
+    # --- write side (event loop thread) ---
+
+    def set(self, section, key, value):
+        key = str(key)  # JSON object keys, slot 12 is "12"
+        items = self.sections[section]
+        if items.get(key) == value:
+            return
+        if value is None:
+            items.pop(key, None)
+        else:
+            items[key] = value
+        self._changed(f"{section}/{key}", value)
+
+    def merge(self, section, key, **fields):
+        """Update some fields of one entry, the others stay."""
+        current = self.sections[section].get(str(key)) or {}
+        if current and all(current.get(k) == v for k, v in fields.items()):
+            return
+        self.set(section, key, dict(current, **fields))
+
+    def add_event(self, event):
+        event = dict(event)
+        self.events.append(event)
+        self._flush()  # anything changed before it goes out first
+        self._publish({"type": "event", "event": event})
+
+    # --- read side ---
+
+    def snapshot(self):
+        return {"type": "snapshot", "seq": self.seq, "state": copy.deepcopy(self.sections), "events": list(self.events)}
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE)
+        queue.put_nowait(self.snapshot())
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    # --- internals ---
+
+    def _changed(self, path, value):
+        self._pending[path] = copy.deepcopy(value)
+        if self._flush_scheduled:
+            return
+        try:
+            asyncio.get_running_loop().call_soon(self._flush)
+            self._flush_scheduled = True
+        except RuntimeError:  # no loop running (setup, tests), nobody can be listening either
+            self._flush()
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+        changes, self._pending = self._pending, {}
+        self._publish({"type": "diff", "changes": changes})
+
+    def _publish(self, message):
+        self.seq += 1
+        message["seq"] = self.seq
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:  # too slow, the backlog is worth less than a fresh start
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.snapshot())
+
+
+# --- HTTP ---
+
+def _response(writer, status, body, content_type="application/json"):
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                 "Access-Control-Allow-Origin: *\r\nCache-Control: no-store\r\nConnection: close\r\n\r\n".encode() + body)
+
+
+def _json(value):
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+async def _read_request(reader):
+    request = await asyncio.wait_for(reader.readline(), 5.0)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), 5.0)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    parts = request.decode("latin-1").split()
+    return (parts[0], parts[1].split("?")[0]) if len(parts) >= 2 else (None, None), headers
+
+
+def _route(live, path):
+    if path in ("/", "/state"):
+        snap = live.snapshot()
+        return "200 OK", {"seq": snap["seq"], "state": snap["state"], "events": snap["events"]}
+    if path == "/events":
+        return "200 OK", {"seq": live.seq, "events": list(live.events)}
+    if path.startswith("/state/") and path[7:] in live.sections:
+        return "200 OK", {"seq": live.seq, path[7:]: live.sections[path[7:]]}
+    return "404 Not Found", {"error": "not found"}
+
+
+# --- WebSocket (RFC 6455, server side, text frames only) ---
+
+def _ws_frame(payload, opcode=0x1):
+    n = len(payload)
+    if n < 126:
+        header = bytes([0x80 | opcode, n])
+    elif n < 65536:
+        header = bytes([0x80 | opcode, 126]) + n.to_bytes(2, "big")
+    else:
+        header = bytes([0x80 | opcode, 127]) + n.to_bytes(8, "big")
+    return header + payload
+
+
+async def _ws_read_frame(reader):
+    """(opcode, payload) of the next client frame. Client frames are always masked."""
+    b1, b2 = await reader.readexactly(2)
+    n = b2 & 0x7F
+    if n == 126:
+        n = int.from_bytes(await reader.readexactly(2), "big")
+    elif n == 127:
+        n = int.from_bytes(await reader.readexactly(8), "big")
+    if n > MAX_CLIENT_FRAME:
+        raise ConnectionError("client frame too big")
+    mask = await reader.readexactly(4) if b2 & 0x80 else b"\0\0\0\0"
+    data = await reader.readexactly(n)
+    return b1 & 0x0F, bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+
+async def _websocket(live, reader, writer, headers):
+    key = headers.get("sec-websocket-key")
+    if not key or "websocket" not in headers.get("upgrade", "").lower():
+        _response(writer, "400 Bad Request", _json({"error": "expected a websocket upgrade"}))
+        return
+    accept = base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+    writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+    queue = live.subscribe()
+
+    async def send_loop():
+        while True:
+            message = await queue.get()
+            writer.write(_ws_frame(_json(message)))
+            await writer.drain()
+
+    async def receive_loop():
+        while True:
+            opcode, payload = await _ws_read_frame(reader)
+            if opcode == 0x8:  # close
+                writer.write(_ws_frame(payload[:2], 0x8))
+                return
+            if opcode == 0x9:  # ping
+                writer.write(_ws_frame(payload, 0xA))
+            elif opcode == 0x1 and payload.strip() == b"snapshot":  # a client can ask to start over
+                writer.write(_ws_frame(_json(live.snapshot())))
+
+    tasks = [asyncio.create_task(send_loop()), asyncio.create_task(receive_loop())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        live.unsubscribe(queue)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def serve(host, port, live):
+    """Answer the API on host:port until cancelled."""
+
+    async def handle(reader, writer):
+        try:
+            (method, path), headers = await _read_request(reader)
+            if method != "GET":
+                _response(writer, "405 Method Not Allowed", _json({"error": "read only"}))
+            elif path == "/ws":
+                await _websocket(live, reader, writer, headers)
+            else:
+                status, body = _route(live, path)
+                _response(writer, status, _json(body))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, UnicodeDecodeError):
+            pass
+        except asyncio.CancelledError:  # shutting down with a websocket open. this is the top of the handler's own task, 3.11 logs it as an error otherwise
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    general_log.info("Live state API on http://%s:%s/state and ws://%s:%s/ws", host, port, host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,194 @@
+"""In-memory slot -> battery index fed by Firebase Realtime Database stream events.
+
+The LED manager used to download the whole BatteryList (every ChargingRecords
+history included) twice a second. Instead we subscribe once with
+db.reference("BatteryList").listen(...) and apply the put/patch events here,
+keeping only the handful of fields the LEDs actually care about.
+
+Anything that produces objects with .event_type ("put"/"patch"), .path and .data
+can drive this, so a local stand-in database works the same as the real listener.
+"""
+import threading
+
+from timeutil import epoch_or_parse
+
+# fields on BatteryList/<tag> that change what the LEDs show or which battery goes next (see next_up.py). everything else (ChargingRecords...) is ignored
+RELEVANT_FIELDS = ("IsCharging", "ChargingSlot", "ChargingStartTime", "ChargingStartEpoch", "TotalCycles", "AverageChargeTime")
+
+
+def _split_path(path):
+    return [p for p in (path or "").split("/") if p]
+
+
+def _start_epoch(fields):
+    # parsed once when the field changes, never on an LED pass
+    return epoch_or_parse(fields.get("ChargingStartEpoch"), fields.get("ChargingStartTime"))
+
+
+class BatteryIndex:
+    """Keeps slot -> (tag, fields) and the minTime setting up to date from stream events.
+
+    The add_listener() callbacks run whenever something the LEDs depend on
+    changes, so the LED manager can sleep instead of polling. The real listeners
+    deliver their first snapshot later, on firebase's own thread, so `loaded`
+    tells the LED manager when there is something worth drawing.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batteries = {}   # tag -> {field: value} (RELEVANT_FIELDS only, plus the parsed start epoch)
+        self._tag_slot = {}    # tag -> slot it currently occupies in slot_to_battery
+        self._slot_to_battery = {}  # slot -> (tag, fields)
+        self.min_time = 0
+        self._dirty = set()    # slots whose entry changed since the last take_changes()
+        self._full = True      # the whole map was replaced since the last take_changes()
+        self._listeners = []   # called (from the listener thread) after every relevant change
+        self._snapshots = set() # "BatteryList" / "minTime" once their first full snapshot came in
+
+    # --- event entry points ---
+
+    def on_battery_event(self, event):
+        """Listener callback for db.reference("BatteryList").listen()."""
+        self.apply(event.event_type, event.path, event.data)
+
+    def on_min_time_event(self, event):
+        """Listener callback for db.reference("Settings/minTime").listen()."""
+        if event.event_type not in ("put", "patch") or _split_path(event.path):
+            return
+        try:
+            value = int(event.data or 0)
+        except (TypeError, ValueError):
+            value = 0
+        with self._lock:
+            first = self._snapshot_seen("minTime")
+            if value == self.min_time and not first:
+                return
+            self.min_time = value
+            self._mark_changed()
+
+    def apply(self, event_type, path, data):
+        """Apply one put/patch event (path relative to BatteryList). Returns True if anything relevant changed."""
+        segments = _split_path(path)
+        with self._lock:
+            if event_type == "put":
+                dirty = self._put(segments, data)
+                if not segments:
+                    dirty = self._snapshot_seen("BatteryList") or dirty
+            elif event_type == "patch" and isinstance(data, dict):
+                dirty = False
+                for key, value in data.items():  # patch keys can be multi segment paths ("tag/IsCharging")
+                    dirty = self._put(segments + _split_path(key), value) or dirty
+            else:
+                return False
+            if dirty:
+                self._mark_changed()
+            return dirty
+
+    def add_listener(self, callback):
+        """Call callback() whenever something relevant changed. Keep it cheap, it runs with the index locked
+        (the asyncio runtime uses loop.call_soon_threadsafe to set its own event)."""
+        self._listeners.append(callback)
+
+    # --- read side ---
+
+    @property
+    def loaded(self):
+        """True once both the BatteryList and the minTime snapshots arrived. Before that the map is empty and
+        min_time is 0, drawing from it would flash every slot and call every charging battery done."""
+        with self._lock:
+            return len(self._snapshots) == 2
+
+    def take_changes(self):
+        """Return ({slot: (tag, fields) or None}, min_time, full) for the slots that changed since the
+        last call and forget them. full=True means the map was replaced and the dict is all of it."""
+        with self._lock:
+            if self._full:
+                changes = dict(self._slot_to_battery)
+            else:
+                changes = {slot: self._slot_to_battery.get(slot) for slot in self._dirty}
+            full = self._full
+            self._dirty.clear()
+            self._full = False
+            return changes, self.min_time, full
+
+    # --- internals (caller holds self._lock) ---
+
+    def _snapshot_seen(self, name):
+        # True the first time, so the listeners get woken up even if the snapshot itself changed nothing
+        if name in self._snapshots:
+            return False
+        self._snapshots.add(name)
+        return True
+
+    def _mark_changed(self):
+        for callback in self._listeners:
+            callback()
+
+    def _put(self, segments, value):
+        if not segments:  # whole BatteryList replaced (this is the initial snapshot from listen())
+            before = dict(self._slot_to_battery)
+            self._batteries.clear()
+            self._tag_slot.clear()
+            self._slot_to_battery.clear()
+            for tag, battery in (value or {}).items():
+                if isinstance(battery, dict):
+                    self._batteries[tag] = self._pick_fields(battery)
+                    self._reindex(tag)
+            self._dirty.clear()
+            self._full = True
+            return before != self._slot_to_battery
+
+        tag = segments[0]
+        if len(segments) == 1:  # whole battery node written or deleted
+            fields = self._pick_fields(value) if isinstance(value, dict) else None
+            if fields == self._batteries.get(tag):
+                return False
+            if fields is None:
+                self._batteries.pop(tag, None)
+            else:
+                self._batteries[tag] = fields
+            return self._reindex(tag)
+
+        field = segments[1]
+        if field not in RELEVANT_FIELDS or len(segments) > 2:
+            return False  # ChargingRecords and friends, the LEDs dont care
+        fields = self._batteries.setdefault(tag, {})
+        if fields.get(field) == value:
+            return False
+        if value is None:
+            fields.pop(field, None)
+        else:
+            fields[field] = value
+        if field in ("ChargingStartTime", "ChargingStartEpoch"):
+            fields["_start_epoch"] = _start_epoch(fields)
+        return self._reindex(tag)
+
+    @staticmethod
+    def _pick_fields(battery):
+        fields = {k: battery[k] for k in RELEVANT_FIELDS if battery.get(k) is not None}
+        fields["_start_epoch"] = _start_epoch(fields)
+        return fields
+
+    def _reindex(self, tag):
+        """Recompute where `tag` sits in slot_to_battery. O(1), returns True if the slot view changed."""
+        old_slot = self._tag_slot.pop(tag, None)
+        old_entry = self._slot_to_battery.get(old_slot) if old_slot is not None else None
+        if old_entry is not None and old_entry[0] == tag:
+            del self._slot_to_battery[old_slot]
+        else:
+            old_entry = None
+
+        fields = self._batteries.get(tag)
+        if fields and fields.get("IsCharging") and fields.get("ChargingSlot") is not None:
+            slot = fields["ChargingSlot"]
+            new_entry = (tag, dict(fields))
+            self._slot_to_battery[slot] = new_entry
+            self._tag_slot[tag] = slot
+            if old_slot != slot or old_entry != new_entry:
+                self._dirty.update(s for s in (old_slot, slot) if s is not None)
+                return True
+            return False
+        if old_entry is not None:
+            self._dirty.add(old_slot)
+            return True
+        return False
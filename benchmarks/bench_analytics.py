@@ -0,0 +1,60 @@
+"""analytics.py over a synthetic charge history: SQLite read and numpy trends for N cycles.
+
+Every battery gets a base charge time, some get slower every day (those should
+come out as degrading), cycles are spread over a year.
+
+    python3 benchmarks/bench_analytics.py [cycles] [batteries]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import analytics  # noqa: E402
+from history import ChargeHistory  # noqa: E402
+
+
+def synthetic_rows(cycles, batteries, seed=1):
+    rng = random.Random(seed)
+    now = time.time()
+    base = {f"{b:010d}": rng.uniform(1800, 3600) for b in range(batteries)}
+    slowing = {tag: (rng.uniform(10, 30) if rng.random() < 0.2 else 0.0) for tag in base}  # seconds per day
+    tags = sorted(base)
+    rows = []
+    records = dict.fromkeys(tags, 0)
+    for _ in range(cycles):
+        tag = rng.choice(tags)
+        start = now - rng.uniform(0, 365) * analytics.DAY
+        age = (start - (now - 365 * analytics.DAY)) / analytics.DAY
+        duration = base[tag] + slowing[tag] * age + rng.gauss(0, 120)
+        rows.append((tag, records[tag], rng.randrange(7), start, start + duration, duration, 1))
+        records[tag] += 1
+    return rows, {tag for tag, s in slowing.items() if s}
+
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    batteries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rows, slowing = synthetic_rows(cycles, batteries)
+    history = ChargeHistory(os.path.join(tempfile.mkdtemp(prefix="battery-history-"), "charge_history.db"))
+    t = time.perf_counter()
+    history.add_cycles(rows)
+    print(f"insert {cycles} cycles: {(time.perf_counter() - t) * 1000:.1f}ms")
+
+    t = time.perf_counter()
+    tags, starts, _, durations = history.columns()
+    read = time.perf_counter() - t
+    t = time.perf_counter()
+    trends = analytics.battery_trends(tags, starts, durations)
+    compute = time.perf_counter() - t
+    print(f"read: {read * 1000:.1f}ms, trends for {len(trends)} batteries: {compute * 1000:.1f}ms")
+
+    flagged = set(analytics.degrading(trends))
+    print(f"degrading: {len(flagged)} flagged, {len(flagged & slowing)}/{len(slowing)} of the slowing ones, {len(flagged - slowing)} false positives")
+
+
+if __name__ == "__main__":
+    main()
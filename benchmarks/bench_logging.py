@@ -0,0 +1,113 @@
+"""Logging overhead per slot event, old synchronous setup vs the queued pipeline in logging_setup.py.
+
+Runs the log calls one PRESENT -> match -> commit -> LED refresh cycle makes, the way the
+code made them before (f-strings, DEBUG to a RotatingFileHandler + ColorFormatter in the
+calling thread) and the way it makes them now (lazy %-args, INFO, QueueHandler, repeat filter).
+Only the time spent in the calling thread is counted, that is what the serial/LED threads pay.
+
+    python3 benchmarks/bench_logging.py [events]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from logging_setup import LOG_FORMAT, ColorFormatter, configure_logging, stop_logging  # noqa: E402
+
+serial_log = logging.getLogger("SERIAL")
+match_log = logging.getLogger("MATCH PROCESS")
+firebase_log = logging.getLogger("FIREBASE")
+led_log = logging.getLogger("LED")
+time_log = logging.getLogger("TIME")
+
+
+def reset_root():
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+        h.close()
+
+
+def old_timestamp(ts):
+    time_log.debug("Timestamp format set")
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def new_timestamp(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def old_event(i, now):
+    tag = f"{1000000000 + i}"
+    raw_line = f"{i} SLOT_{i % 7}:PRESENT"
+    serial_log.info(f"RAW LINE: '{raw_line}' from /dev/ttyACM0")
+    match_log.debug(f"Comparing tag time {old_timestamp(now)} to slot time {old_timestamp(now)}")
+    match_log.info(f"Tag Pulled: {tag}")
+    match_log.info(f"Tag {tag} matched to slot {i % 7} at {old_timestamp(now)}")
+    firebase_log.debug("Added to CurrentChargingList")
+    firebase_log.debug(f"Checking for name for {tag}")
+    firebase_log.info(f"Name Exists for ID:{tag}")
+    for slot in range(7):  # one LED pass after the event
+        led_log.info(f"Battery {tag} in slot {slot} is charging")
+    led_log.info("No fully charged slots available.")
+    led_log.info(f"Next slot to pick: {None}")
+    serial_log.debug("safe write serial set")
+    serial_log.debug("serial opened")
+
+
+def new_event(i, now):
+    tag = f"{1000000000 + i}"
+    raw_line = b"%d SLOT_%d:PRESENT" % (i, i % 7)
+    serial_log.info("RAW LINE: %r from %s", raw_line, "/dev/ttyACM0")
+    match_log.info("Tag Pulled: %s", tag)
+    match_log.info("Tag %s matched to slot %s at %s", tag, i % 7, new_timestamp(now))
+    firebase_log.debug("Checking for name for %s", tag)
+    firebase_log.info("Name Exists for ID:%s", tag)
+    for slot in range(7):
+        led_log.debug("Battery %s in slot %s is charging", tag, slot)
+    led_log.debug("No fully charged slots available.")
+    led_log.debug("Next slot to pick: %s", None)
+
+
+def run(label, event, events):
+    now = time.time()
+    start = time.perf_counter()
+    for i in range(events):
+        event(i, now)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / events * 1e6:9.1f} us/event  ({events} events)")
+    return elapsed
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    devnull = open(os.devnull, "w")
+    with tempfile.TemporaryDirectory() as tmp:
+        # before: everything synchronous in the calling thread, root at DEBUG
+        root = logging.getLogger()
+        root.setLevel(logging.DEBUG)
+        file_handler = RotatingFileHandler(os.path.join(tmp, "old.txt"), maxBytes=5*1024*1024, backupCount=5, encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        console_handler = logging.StreamHandler(devnull)
+        console_handler.setLevel(logging.INFO)
+        console_handler.setFormatter(ColorFormatter(LOG_FORMAT))
+        root.addHandler(file_handler)
+        root.addHandler(console_handler)
+        before = run("before (sync, f-strings)", old_event, events)
+        reset_root()
+
+        # after: queue handler + listener thread, lazy args, INFO
+        listener = configure_logging(os.path.join(tmp, "new.txt"), level=logging.INFO, stream=devnull)
+        after = run("after (queued, lazy)", new_event, events)
+        stop_logging(listener)
+        reset_root()
+    devnull.close()
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Slot event pipeline: insert-to-commit latency, Firebase calls per event and throughput.
+
+Each scenario runs simulator.py in its own process (input_listener keeps its
+state in module globals) against ptys and the in-memory fake database, and the
+JSON results are put side by side. "latency" is the delay added to every fake
+Firebase call, 0 measures our own overhead, 0.02-0.05 is closer to a Pi on wifi.
+
+The paced scenarios play events a realistic gap apart, so they measure latency
+(their events/sec would only echo the gap). Throughput comes from separate
+unpaced runs that write the whole script at once and time the first to the last
+commit.
+
+    python3 benchmarks/bench_pipeline.py [events]
+"""
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# name, simulator arguments
+SCENARIOS = [
+    ("1 rack, no latency", ["--racks", "1", "--gap", "0.005"]),
+    ("3 racks, no latency", ["--racks", "3", "--gap", "0.002"]),
+    ("1 rack, 20ms firebase", ["--racks", "1", "--gap", "0.05", "--latency", "0.02"]),
+    ("3 racks, 20ms firebase", ["--racks", "3", "--gap", "0.02", "--latency", "0.02"]),
+]
+
+UNPACED = ["--speed", "1000000"]  # the whole script lands at once, the pipeline runs flat out
+THROUGHPUT_SCENARIOS = [
+    ("1 rack, no latency", ["--racks", "1"] + UNPACED),
+    ("3 racks, no latency", ["--racks", "3"] + UNPACED),
+    ("3 racks, 20ms firebase", ["--racks", "3", "--latency", "0.02"] + UNPACED),
+]
+
+
+def run_scenario(args, events):
+    out = subprocess.run(
+        [sys.executable, os.path.join(REPO_DIR, "simulator.py"), "--json", "--events", str(events)] + args,
+        capture_output=True, text=True, timeout=600,
+    )
+    lines = [line for line in out.stdout.splitlines() if line.startswith("{")]
+    if not lines:
+        raise RuntimeError(f"simulator failed:\n{out.stdout}\n{out.stderr}")
+    return json.loads(lines[-1])
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    print(f"{events} slot events per scenario\n")
+    print("commit latency (paced)")
+    print(f"{'scenario':<26}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'fb calls/ev':>13}{'committed':>11}")
+    for name, args in SCENARIOS:
+        r = run_scenario(args, events)
+        lat = r["latency_ms"]
+        print(f"{name:<26}{lat['p50']:>10}{lat['p95']:>10}{lat['p99']:>10}{lat['max']:>10}"
+              f"{r['firebase_calls_per_event']:>13}{r['committed']:>7}/{r['expected']}")
+
+    print("\nthroughput (unpaced)")
+    print(f"{'scenario':<26}{'events/s':>10}{'drain s':>10}{'fb calls/ev':>13}{'committed':>11}")
+    for name, args in THROUGHPUT_SCENARIOS:
+        r = run_scenario(args, events)
+        print(f"{name:<26}{r['commit_rate']:>10}{r['elapsed_s']:>10}"
+              f"{r['firebase_calls_per_event']:>13}{r['committed']:>7}/{r['expected']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Small thread-safe TTL + LRU cache for Firebase values that almost never change.
+
+Settings/minTime and BatteryNames/<tag> change maybe once a week, but used to
+be fetched on every LED pass / slot event. Values are kept until their TTL runs
+out or a Firebase listener tells us they changed, whichever comes first.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize=256, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (value, expires_at), oldest used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader=None, default=None):
+        """Return the cached value for key. On a miss call loader() (outside the lock) and cache what it returns."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and item[1] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+        if loader is None:
+            return default
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key=_MISSING):
+        """Drop one key, or everything if no key is given."""
+        with self._lock:
+            if key is _MISSING:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
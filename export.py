@@ -0,0 +1,236 @@
+"""Export BatteryList (every battery and its ChargingRecords) without downloading the whole tree.
+
+Battery tags come from one shallow listing, each battery's fields from a
+shallow get of its node, and ChargingRecords are read PAGE_SIZE records at a
+time with order_by_key().start_at().limit_to_first() queries. Everything is a
+generator, so memory stays at about one page no matter how big the fleet is.
+
+Output is NDJSON (everything, one object per line, loadable back into
+fakedb.FakeDatabase for offline testing with load_export()) or CSV (the
+charging records only, one row each). A checkpoint next to the output records
+the last finished battery and how far the file got, --resume carries on from
+there after a crash or a dropped connection. --history also backfills the local
+charge_history.db (history.py) from the records as they stream past.
+
+    python3 export.py OUT [--format ndjson|csv] [--page N] [--resume] [--history charge_history.db]
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+
+PAGE_SIZE = 100 # ChargingRecords per query
+CHECKPOINT_EVERY = 20 # batteries between checkpoints (each one is an fsync)
+CSV_FIELDS = ["tag", "record", "ChargingSlot", "StartTime", "StartEpoch", "EndTime", "EndEpoch", "Duration"]
+
+
+def _key_order(key):
+    # how the server orders keys for order_by_key()/start_at(): keys that are 32 bit ints first, numerically, then strings
+    key = str(key)
+    if key.lstrip("-").isdigit() and -2**31 <= int(key) < 2**31:
+        return (0, int(key), "")
+    return (1, 0, key)
+
+
+def _items(page):
+    # firebase hands back mostly numeric keys as a list (holes are None), otherwise a dict.
+    # the SDK sorts a dict by plain string ("10" before "9"), put it back in the server's order so paging lines up with start_at
+    if isinstance(page, list):
+        return [(str(i), v) for i, v in enumerate(page) if v is not None]
+    return sorted((page or {}).items(), key=lambda item: _key_order(item[0]))
+
+
+def iter_records(ref, page_size=PAGE_SIZE):
+    """Yield (key, record) for every child of ref in key order, page_size per query."""
+    after = None
+    while True:
+        query = ref.order_by_key()
+        if after is not None:
+            query = query.start_at(after) # inclusive, so ask for one more and drop it
+        items = _items(query.limit_to_first(page_size + (after is not None)).get())
+        if after is not None:
+            items = [(k, v) for k, v in items if k != after]
+        yield from items
+        if len(items) < page_size:
+            return
+        after = items[-1][0] # the largest key in server order, _items() sorted them
+
+
+def battery_fields(ref):
+    """A battery's own fields without its records. A shallow get shows a nested node and a plain True
+    (IsCharging) the same way, so those get read properly. Nothing but ChargingRecords is big."""
+    fields = ref.get(shallow=True) or {}
+    fields.pop("ChargingRecords", None)
+    for key, value in list(fields.items()):
+        if value is True:
+            fields[key] = ref.child(key).get()
+    return fields
+
+
+def iter_fleet(database, page_size=PAGE_SIZE, after=None):
+    """Yield ("battery", tag, fields) then ("record", tag, key, record) for each of its records, battery by battery
+    in tag order. after=tag skips everything up to and including that battery."""
+    battery_list = database.reference("BatteryList")
+    for tag in sorted((battery_list.get(shallow=True) or {}).keys()):
+        if after is not None and tag <= after:
+            continue
+        node = battery_list.child(tag)
+        yield ("battery", tag, battery_fields(node))
+        for key, record in iter_records(node.child("ChargingRecords"), page_size):
+            yield ("record", tag, key, record)
+
+
+def history_cycle(tag, key, record, min_time):
+    """history.ChargeHistory row for a finished record, None for open or broken ones."""
+    from timeutil import epoch_or_parse
+    if not isinstance(record, dict) or record.get("Duration") in (None, ""):
+        return None
+    start = epoch_or_parse(record.get("StartEpoch"), record.get("StartTime"))
+    end = epoch_or_parse(record.get("EndEpoch"), record.get("EndTime"))
+    if start is None or end is None:
+        return None
+    duration = int(float(record["Duration"]))
+    return (tag, int(key), record.get("ChargingSlot"), start, end, duration, duration >= min_time)
+
+
+class _Output:
+    """Line writer with the byte offset of the last checkpoint, truncates back to it on resume."""
+
+    def __init__(self, path, fmt, resume_from=None):
+        self.path = path
+        self.fmt = fmt
+        self.checkpoint_path = path + ".checkpoint"
+        if resume_from is not None:
+            self.file = open(path, "r+b")
+            self.file.truncate(resume_from["offset"]) # whatever came after the checkpoint gets written again
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            if fmt == "csv":
+                self._csv_row(CSV_FIELDS)
+
+    def _csv_row(self, row):
+        buf = io.StringIO()
+        csv.writer(buf, lineterminator="\n").writerow(row)
+        self.file.write(buf.getvalue().encode())
+
+    def write(self, item):
+        if self.fmt == "ndjson":
+            if item[0] == "battery":
+                line = {"type": "battery", "tag": item[1], "data": item[2]}
+            else:
+                line = {"type": "record", "tag": item[1], "key": item[2], "data": item[3]}
+            self.file.write(json.dumps(line, separators=(",", ":")).encode() + b"\n")
+        elif item[0] == "record":
+            record = item[3] if isinstance(item[3], dict) else {}
+            self._csv_row([item[1], item[2]] + [record.get(f, "") for f in CSV_FIELDS[2:]])
+
+    def checkpoint(self, state):
+        self.file.flush()
+        os.fsync(self.file.fileno()) # the offset can never point past what is on disk
+        state = dict(state, offset=self.file.tell(), format=self.fmt)
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint_path)
+
+    def finish(self):
+        self.file.close()
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+def load_checkpoint(path):
+    try:
+        with open(path + ".checkpoint") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def export(database, path, fmt="ndjson", page_size=PAGE_SIZE, resume=False, history=None, log=print):
+    """Stream the fleet into path. Returns {"batteries": n, "records": n} for this run."""
+    checkpoint = load_checkpoint(path) if resume else None
+    if checkpoint and checkpoint.get("format") != fmt:
+        raise ValueError(f"checkpoint for {path} is a {checkpoint.get('format')} export")
+    if checkpoint:
+        log(f"Resuming after battery {checkpoint['after']} ({checkpoint['batteries']} batteries done)")
+    out = _Output(path, fmt, checkpoint)
+    min_time = int(database.reference("Settings/minTime").get() or 0) if history is not None else 0
+    state = {"after": None, "batteries": 0, "records": 0}
+    if checkpoint:
+        state.update({k: checkpoint[k] for k in state})
+    done_batteries = state["batteries"]
+    cycles = []
+    current = None
+    for item in iter_fleet(database, page_size, after=state["after"]):
+        if item[0] == "battery":
+            if current is not None: # the one before is complete
+                state["after"] = current
+                state["batteries"] += 1
+                if state["batteries"] % CHECKPOINT_EVERY == 0:
+                    if cycles: # everything before the checkpoint has to be in the history too
+                        history.add_cycles(cycles)
+                        cycles = []
+                    out.checkpoint(state)
+            current = item[1]
+        else:
+            state["records"] += 1
+            if history is not None:
+                cycle = history_cycle(item[1], item[2], item[3], min_time)
+                if cycle:
+                    cycles.append(cycle)
+                    if len(cycles) >= page_size:
+                        history.add_cycles(cycles)
+                        cycles = []
+        out.write(item)
+    if current is not None:
+        state["batteries"] += 1
+    if cycles:
+        history.add_cycles(cycles)
+    out.finish()
+    log(f"Exported {state['batteries'] - done_batteries} batteries ({state['batteries']} total, {state['records']} records) to {path}")
+    return {"batteries": state["batteries"] - done_batteries, "records": state["records"]}
+
+
+def load_export(path):
+    """Turn an NDJSON export back into a {"BatteryList": {...}} tree, e.g. FakeDatabase(load_export(path))."""
+    batteries = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            battery = batteries.setdefault(item["tag"], {})
+            if item["type"] == "battery":
+                battery.update(item["data"])
+            else:
+                battery.setdefault("ChargingRecords", {})[item["key"]] = item["data"]
+    return {"BatteryList": batteries}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream BatteryList and its ChargingRecords out of firebase page by page.")
+    parser.add_argument("out", help="file to write")
+    parser.add_argument("--format", choices=("ndjson", "csv"), default="ndjson")
+    parser.add_argument("--page", type=int, default=PAGE_SIZE, help="ChargingRecords per query")
+    parser.add_argument("--resume", action="store_true", help="carry on from OUT.checkpoint")
+    parser.add_argument("--history", help="also backfill this charge history database (charge_history.db)")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    import input_listener
+    load_dotenv()
+    input_listener.init_firebase()
+    history = None
+    if args.history:
+        from history import ChargeHistory
+        history = ChargeHistory(args.history)
+    export(input_listener.db, args.out, args.format, args.page, args.resume, history)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""In-memory stand-in for the firebase_admin.db API, for the simulator and benchmarks.
+
+Covers what input_listener and export.py use: reference(path), child(),
+get(shallow=), set(), update() with multi-path keys, listen() with put/patch
+events shaped like the real ones (.event_type, .path, .data), and
+order_by_key() queries with start_at/end_at/limit_to_first/limit_to_last. Every call is counted so a run
+can report Firebase calls per slot event, and `latency` adds a fixed delay per
+call to stand in for the network round trip.
+
+Listener callbacks run on the thread that did the write, the real SDK uses its
+own thread, so anything they touch has to be thread safe either way.
+"""
+import copy
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+def _split(path):
+    return [p for p in (path or "").split("/") if p]
+
+
+def _key_order(key):
+    # firebase puts keys that are 32 bit ints first, in numeric order, then the rest as strings
+    key = str(key)
+    if key.lstrip("-").isdigit() and -2**31 <= int(key) < 2**31:
+        return (0, int(key), "")
+    return (1, 0, key)
+
+
+class Event:
+    def __init__(self, event_type, path, data):
+        self.event_type = event_type
+        self.path = path
+        self.data = data
+
+    def __repr__(self):
+        return f"Event({self.event_type!r}, {self.path!r}, {self.data!r})"
+
+
+class ListenerRegistration:
+    def __init__(self, db, segments, callback):
+        self._db = db
+        self.segments = segments
+        self.callback = callback
+
+    def close(self):
+        with self._db._lock:
+            if self in self._db._listeners:
+                self._db._listeners.remove(self)
+
+
+class FakeDatabase:
+    def __init__(self, data=None, latency=0.0):
+        self._root = copy.deepcopy(data) if data else {}
+        self._lock = threading.RLock()
+        self._listeners = []
+        self.latency = latency
+        self.calls = Counter()  # "get" / "set" / "update" / "listen" -> count
+        self.write_log = []     # (time, method, path, data) for every write, in order
+        self.record_writes = True
+
+    def reference(self, path="/"):
+        return Reference(self, _split(path))
+
+    def snapshot(self, path="/"):
+        """Current value at path without counting a call, for checking results."""
+        with self._lock:
+            return copy.deepcopy(self._get(_split(path)))
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.write_log.clear()
+
+    # --- internals ---
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, segments):
+        node = self._root
+        for seg in segments:
+            if not isinstance(node, dict) or seg not in node:
+                return None
+            node = node[seg]
+        return node
+
+    def _set(self, segments, value):
+        if not segments:
+            self._root = copy.deepcopy(value) if isinstance(value, dict) else {}
+            return
+        node = self._root
+        parents = []
+        for seg in segments[:-1]:
+            parents.append((node, seg))
+            child = node.get(seg)
+            if not isinstance(child, dict):
+                if value is None:
+                    return  # deleting something that isn't there
+                child = node[seg] = {}
+            node = child
+        if value is None:
+            node.pop(segments[-1], None)
+            for parent, seg in reversed(parents):  # firebase doesn't keep empty nodes around
+                if parent[seg]:
+                    break
+                del parent[seg]
+        else:
+            node[segments[-1]] = copy.deepcopy(value)
+
+    def _write(self, method, base, changes):
+        """Apply [(segments, value)] atomically, then tell the listeners."""
+        with self._lock:
+            for segments, value in changes:
+                self._set(segments, value)
+            if self.record_writes:
+                self.write_log.append((time.time(), method, "/" + "/".join(base), {"/".join(s[len(base):]): v for s, v in changes} if method == "update" else changes[0][1]))
+            notify = []
+            for reg in list(self._listeners):
+                event = self._event_for(reg.segments, method, base, changes)
+                if event is not None:
+                    notify.append((reg.callback, event))
+        for callback, event in notify:
+            callback(event)
+
+    def _event_for(self, listen_at, method, base, changes):
+        n = len(listen_at)
+        patch = {}
+        for segments, value in changes:
+            if segments[:n] == listen_at:
+                rel = segments[n:]
+                if not rel:
+                    return Event("put", "/", copy.deepcopy(self._get(listen_at)))
+                patch["/".join(rel)] = copy.deepcopy(value)
+            elif listen_at[:len(segments)] == segments:  # something above the listener was replaced
+                return Event("put", "/", copy.deepcopy(self._get(listen_at)))
+        if not patch:
+            return None
+        if method == "set":
+            (rel, value), = patch.items()
+            return Event("put", "/" + rel, value)
+        return Event("patch", "/", patch)
+
+
+class Reference:
+    def __init__(self, db, segments):
+        self._db = db
+        self._segments = segments
+
+    @property
+    def path(self):
+        return "/" + "/".join(self._segments)
+
+    def child(self, path):
+        return Reference(self._db, self._segments + _split(path))
+
+    def get(self, shallow=False):
+        self._db._call("get")
+        with self._db._lock:
+            value = self._db._get(self._segments)
+            if shallow and isinstance(value, dict):
+                return {k: (True if isinstance(v, dict) else v) for k, v in value.items()}
+            return copy.deepcopy(value)
+
+    def set(self, value):
+        self._db._call("set")
+        self._db._write("set", self._segments, [(self._segments, value)])
+
+    def update(self, value):
+        if not isinstance(value, dict) or not value:
+            raise ValueError("Value argument must be a non-empty dictionary.")
+        self._db._call("update")
+        self._db._write("update", self._segments, [(self._segments + _split(k), v) for k, v in value.items()])
+
+    def delete(self):
+        self._db._call("delete")
+        self._db._write("set", self._segments, [(self._segments, None)])
+
+    def order_by_key(self):
+        return Query(self)
+
+    def listen(self, callback):
+        """Deliver the current value as a put at "/" straight away, then every change under this path."""
+        self._db._call("listen")
+        reg = ListenerRegistration(self._db, self._segments, callback)
+        with self._db._lock:
+            self._db._listeners.append(reg)
+            initial = Event("put", "/", copy.deepcopy(self._db._get(self._segments)))
+        callback(initial)
+        return reg
+
+
+class Query:
+    """order_by_key() query. The keys are picked in the server's order (_key_order), but get() returns them sorted
+    as plain strings like the SDK does ("10" before "9"), {} when nothing matches."""
+
+    def __init__(self, ref):
+        self._ref = ref
+        self._start = self._end = None
+        self._first = self._last = None
+
+    def start_at(self, key):
+        self._start = key
+        return self
+
+    def end_at(self, key):
+        self._end = key
+        return self
+
+    def limit_to_first(self, n):
+        self._first = n
+        return self
+
+    def limit_to_last(self, n):
+        self._last = n
+        return self
+
+    def get(self):
+        db = self._ref._db
+        db._call("get")
+        with db._lock:
+            value = db._get(self._ref._segments)
+            if isinstance(value, list):
+                value = {str(i): v for i, v in enumerate(value) if v is not None}
+            if not isinstance(value, dict):
+                return OrderedDict()
+            keys = sorted(value, key=_key_order)
+            if self._start is not None:
+                keys = [k for k in keys if _key_order(k) >= _key_order(self._start)]
+            if self._end is not None:
+                keys = [k for k in keys if _key_order(k) <= _key_order(self._end)]
+            if self._first is not None:
+                keys = keys[:self._first]
+            if self._last is not None:
+                keys = keys[-self._last:] if self._last else []
+            return OrderedDict((k, copy.deepcopy(value[k])) for k in sorted(keys, key=str))
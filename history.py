@@ -0,0 +1,81 @@
+"""Local charge history: every completed charge cycle, in an SQLite file next to the journal.
+
+Firebase keeps the same cycles in BatteryList/<tag>/ChargingRecords, but reading
+them back means downloading every battery's records. This copy is for analytics
+(see analytics.py) and never touches the network. One row per cycle, times are
+epoch seconds, and a cycle is keyed by (tag, record index in ChargingRecords)
+so writing the same cycle twice (a commit retried after a timeout) is harmless.
+
+WAL mode so the analytics can read while the committer writes.
+"""
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cycles (
+    tag      TEXT    NOT NULL,
+    record   INTEGER NOT NULL,  -- index in BatteryList/<tag>/ChargingRecords
+    slot     INTEGER,           -- station slot it charged in
+    start    REAL    NOT NULL,  -- epoch seconds
+    end      REAL    NOT NULL,
+    duration INTEGER NOT NULL,  -- whole seconds, same as Duration in firebase
+    counted  INTEGER NOT NULL,  -- 1 if it was at least minTime, i.e. counted in TotalCycles
+    PRIMARY KEY (tag, record)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cycles_tag_end ON cycles (tag, end);
+CREATE INDEX IF NOT EXISTS cycles_end ON cycles (end);
+"""
+
+
+class ChargeHistory:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()  # one connection, used from the firebase executor threads
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")  # WAL + NORMAL survives a crash, a power cut can lose the last cycle or two
+        self._conn.executescript(SCHEMA)
+
+    def add_cycle(self, tag, record, slot, start, end, duration, counted):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cycles (tag, record, slot, start, end, duration, counted) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (tag, record, slot, start, end, int(duration), int(bool(counted))),
+            )
+
+    def add_cycles(self, rows):
+        """Bulk insert [(tag, record, slot, start, end, duration, counted)], one transaction."""
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO cycles (tag, record, slot, start, end, duration, counted) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   ((t, r, s, st, e, int(d), int(bool(c))) for t, r, s, st, e, d, c in rows))
+
+    def columns(self, since=None, until=None, tag=None, counted_only=True):
+        """Cycles as columns (tags, starts, ends, durations), in no particular order. Cheap to hand to numpy."""
+        where, args = [], []
+        if tag is not None:
+            where.append("tag = ?")
+            args.append(tag)
+        if since is not None:
+            where.append("end >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("end < ?")
+            args.append(until)
+        if counted_only:
+            where.append("counted = 1")
+        sql = "SELECT tag, start, end, duration FROM cycles"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        if not rows:
+            return [], [], [], []
+        return tuple(list(col) for col in zip(*rows))
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cycles").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
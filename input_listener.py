@@ -1,56 +1,43 @@
-from datetime import datetime
 import serial
-import threading
+import asyncio
+import signal
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import time
-import json
+_process_start = time.monotonic() # for the time-to-ready measurement
 from os import getenv
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import db
 from dotenv import load_dotenv
 import logging
-from logging.handlers import RotatingFileHandler
 import sys
 import re
+import threading
+import os
+import sqlite3
+from battery_index import BatteryIndex
+from journal import SlotEventJournal
+from history import ChargeHistory
+from cache import TTLCache
+from tag_matcher import PendingTagMatcher
+from serial_io import SerialPortIO, SerialReader
+from logging_setup import configure_logging
+from timeutil import format_timestamp, format_duration, epoch_or_parse
+from racks import load_manifest
+from timers import TimerWheel
+from led_render import FrameRenderer
+from next_up import get_policy
+import metrics
+import api
+from metrics import Counter, Gauge, Histogram
 
 # === CONFIGURATION ===
-load_dotenv()
+# importing this file does nothing but define things. setup() reads the config and starts logging, init_firebase() connects,
+# main() does both (firebase in parallel with opening the serial ports) and runs the tasks.
 
 # === LOGGING CONFIGURATION ===
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-
-# Rotating file handler (keeps last 5 logs, each up to 5MB)
-file_handler = RotatingFileHandler("log.txt", maxBytes=5*1024*1024, backupCount=5, encoding="utf-8")
-file_formatter = logging.Formatter("%(asctime)s [%(name)s] [%(levelname)s] %(message)s")
-file_handler.setFormatter(file_formatter)
-file_handler.setLevel(logging.DEBUG)
-
-# Color-coded console handler
-class ColorFormatter(logging.Formatter):
-    COLORS = {
-        "FIREBASE": "\033[96m",  # cyan
-        "LED": "\033[93m",       # yellow
-        "RFID": "\033[92m",      # green
-        "SERIAL": "\033[95m",    # magenta
-        "TIME": "\033[94m",      # blue
-        "MATCH PROCESS": "\033[91m",  # red
-        "GENERAL": "\033[97m",   # white
-    }
-    RESET = "\033[0m"
-
-    def format(self, record):
-        color = self.COLORS.get(record.name, "\033[97m")
-        formatted = super().format(record)
-        return f"{color}{formatted}{self.RESET}"
-
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.INFO)
-console_formatter = ColorFormatter("%(asctime)s [%(name)s] [%(levelname)s] %(message)s")
-console_handler.setFormatter(console_formatter)
-
-root_logger.addHandler(file_handler)
-root_logger.addHandler(console_handler)
+# everything goes through a queue to one background thread that does the formatting and file/console writes, see logging_setup.py
+LOG_FILE = "log.txt"
+LOG_REPEAT_INTERVAL = 30.0 # seconds, identical log lines inside this window are collapsed into one with a count
+log_listener = None # started by setup()
 
 # Subsystem loggers
 firebase_log = logging.getLogger("FIREBASE")
@@ -85,507 +72,1159 @@ def smart_print(*args, **kwargs):
 # Override built-in print
 print = smart_print
 
-general_log.info("Logging initialized. Program has just been started. ================ LOG START ================")
-general_log.info("===============================================================================================")
-
-# open the json and load the serial port IDS of the arduinos. change hardwareIDS.json to change your hardware ids of your arduinos.
-with open("hardwareIDS.json") as hardwareID:
-    RemoteID = json.load(hardwareID)
-
-COM_PORT1 = RemoteID["COM_PORT1"] #init com ports
-COM_PORT2 = RemoteID["COM_PORT2"] 
+HARDWARE_FILE = "hardwareIDS.json" # change hardwareIDS.json to change your hardware ids of your arduinos. see racks.py for the format
 BAUD_RATE = 9600
+ARDUINO_BOOT_SECONDS = 1.0 #opening a port resets the arduino. nothing gets written to it until it talks to us or this long after opening
 MATCH_WINDOW_SECONDS = 3.0 #change to adjust the window for matching slots and RFID ID numbers.
-FIREBASE_DB_BASE_URL = getenv('FIREBASE_DB_BASE_URL')
-FIREBASE_CREDS_FILE = getenv('FIREBASE_CREDS_FILE')
-
-general_log.info(f"Loaded hardware IDs: {RemoteID}")
-firebase_log.info(f"Firebase initializing.")
-
-# exit the program if firebase credentials are missing
-if not FIREBASE_DB_BASE_URL or not FIREBASE_CREDS_FILE:
-    firebase_log.critical("Missing Firebase configuration in environment variables!")
-    general_log.critical("Missing credentials. Program will not start.")
-    general_log.info("program exited with error")
-    sys.exit(1)
-
-
-# Initialize the app with a service account, granting admin privileges
-cred = credentials.Certificate(FIREBASE_CREDS_FILE)
-firebase_log.info("Creds loaded")
-firebase_admin.initialize_app(cred, {
-    'databaseURL': FIREBASE_DB_BASE_URL
-})
-
-ref = db.reference('/')
+PENDING_TAG_GRACE_SECONDS = 5.0 #scans are kept this long past the match window in case a slot event is processed late, then expired
+pending_tags = PendingTagMatcher(MATCH_WINDOW_SECONDS, PENDING_TAG_GRACE_SECONDS) # RFID scans waiting for a slot, sorted by time. has its own lock
+
+# set by setup() from the rack manifest
+RACKS = []       # racks.Rack for every rack on this pi
+RACK_PORTS = []  # (rack, RackPort) for every arduino, one reader/writer pipeline each
+STATION_SLOTS = [] # station wide slot numbers, this is what ChargingSlot in firebase holds
+
+db = None  # firebase_admin.db (or a stand-in), set by init_firebase()
+ref = None # root reference, set by init_firebase()
+firebase_exceptions = None # firebase_admin.exceptions, imported by init_firebase() so importing this file stays cheap
+transient_errors = () # exceptions that mean firebase or the network is down, not that the event is bad. set by init_firebase()
+data_errors = (ValueError, KeyError, TypeError) # a malformed record or event, retrying it can never work. init_firebase() adds requests' InvalidJSONError
+response_errors = () # ...except these, a response that would not decode (captive portal, body cut off) is the network's fault. set by init_firebase()
+firebase_ready = asyncio.Event() # set once init_firebase() is done and the listeners are up
+rfid_ready = asyncio.Event() # set once listen_rfid is reading
+ready_seconds = None # how long after the process started the station could take a scan and commit it
 
 # === STATE TRACKING ===
-slot_status = {}  # slot_id -> {"state": "PRESENT"/"REMOVED", "last_change": timestamp, "tag": optional tag}
-pending_tags = []  # list of (tag_id, timestamp) tuples
-lock = threading.Lock()
+slot_status = {}  # (rack name, slot on that rack) -> {"state": "PRESENT"/"REMOVED", "last_change": timestamp, "tag": optional tag}
+# only ever touched from the event loop thread, so no lock. firebase calls and sleeps never happen in between reading and writing it
 tag_buffer = ""
+JOURNAL_FILE = "slot_events.journal" # write-ahead journal of charge start/stop events, replayed on startup if firebase never got them
+COMMIT_QUEUE_SIZE = 500 # events held in memory for the committer. past this they wait in the journal until the committer catches up
+COMMIT_MAX_BACKOFF = 60.0 # seconds, longest wait between retries while firebase is unreachable
+journal = None # SlotEventJournal, opened by setup()
+HISTORY_FILE = "charge_history.db" # every finished charge cycle, local copy for analytics.py so trends never need firebase reads
+history = None # ChargeHistory, opened by setup()
+commit_queue = asyncio.Queue(maxsize=COMMIT_QUEUE_SIZE)  # (seq, event, maybe_applied) journaled events waiting for commit_loop
+commit_spill_lock = asyncio.Lock() # held across the journal append so an event cant slip past a refill
+commit_spilled = False # True while there are journaled events that are not in commit_queue (startup replay or queue overflow)
+last_queued_seq = 0
+COMMIT_CONCURRENCY = 4 # batteries committed at the same time. events for one battery still go one at a time, in order
+commit_slots = asyncio.Semaphore(COMMIT_CONCURRENCY) # taken by commit_loop for every event it hands out, so a slow firebase pushes back on the queue
+tag_commits = {} # tag -> task committing that battery's newest event, the next event for the battery waits for it
 
 # === SERIAL SHARED OBJECTS  ===
-# store opened serial.Serial objects here so the LED thread can reuse the same open port
+# store opened serial.Serial objects here so the LED sender can reuse the same open port
 serial_ports = {}            # port_str -> serial.Serial object
-serial_ports_lock = threading.Lock()
+port_open = {}               # port_str -> asyncio.Event, set while handle_serial has the port open
+port_connected = {}          # port_str -> asyncio.Event, set once the arduino behind an open port is up. the LED senders wait on it
+
+# === EXECUTORS ===
+# the event loop runs the serial readers, RFID, LEDs and heartbeat as tasks. anything that blocks goes to a bounded pool so the loop never waits on it
+FIREBASE_WORKERS = 8 # threads for firebase calls and journal fsyncs. COMMIT_CONCURRENCY of them can be busy with commits
+firebase_executor = ThreadPoolExecutor(max_workers=FIREBASE_WORKERS, thread_name_prefix="firebase") # threads only start on first use
+serial_executor = None # opening ports, one thread per port so they all open at once. set by setup()
+led_executor = None # LED sends block on ACKs, at most one per rack at a time. set by setup()
+listener_registrations = [] # firebase listen() streams, closed on shutdown
 
 # === LED CONFIG ===
-POSITIONS = [3, 11, 18, 26, 34, 42, 49]  #pos for 0-6. LED width is defined somewhere i forgot. number is where the leftmost LED is placed.
+# LED positions per slot live in the rack manifest now (defaults to 3, 11, 18, 26, 34, 42, 49 for slots 0-6). LED width is defined somewhere i forgot. number is where the leftmost LED is placed.
 HUE_RED = 0 #hue can be 0-255
 HUE_ORANGE = 25
 HUE_BLUE = 170
 HUE_GREEN = 85
-POLL_INTERVAL = 0.5      # seconds between DB polls. This works do not change it.
+POLL_INTERVAL = 0.5      # seconds between DB polls while things are happening. This works do not change it.
+POLL_IDLE_INTERVAL = 4.0 # poll mode backs off to this when nothing changed for POLL_IDLE_AFTER polls. our own slot events and minTime crossings still wake it straight away
+POLL_IDLE_AFTER = 20
+LED_UPDATE_MODE = "stream" # "stream" = keep a local battery index from a Firebase listener and only re-render on changes. "poll" = old behaviour, download all of BatteryList every POLL_INTERVAL
 HEARTBEAT_INTERVAL = 2.0 # seconds between PING heartbeats. this is used on init then never again. 
-last_sent_command = {}   # slot -> (mode, hue, pos) to reduce redundant writes
+last_sent_command = {}   # station slot -> (mode, hue, pos) to reduce redundant writes
+last_next_up = None      # (tag, slot) last written to BatteryNextUp, it is only written again when the pick changes
+NEXT_UP_POLICY = "longest_rested" # which charged battery goes next: "longest_rested" (charged the longest, how it always worked), "least_cycled" (wear leveling) or "fastest_charger". see next_up.py
 MAX_RETRIES = 5 # if you have special code on your arduino you may need to increase the amount of retries.
 ACK_TIMEOUT = 2.0  # seconds
-ack_received = threading.Event()
-general_log.debug("CONSTANTS INITIALIZED")
+LED_PROTOCOL = "legacy" # "legacy" = one SEG line per slot, stop and wait for ACK, what the arduino code speaks. "frame" = all changed segments in one batch with sequence numbered ACKs, only with firmware that understands F lines (see led_protocol.py). LED_PROTOCOL=frame in .env turns it on
+LED_WINDOW = 8 # max segments in flight before waiting for ACKs (frame protocol)
+LED_RESEND_DELAY = 5.0 # seconds before segments that were never acked get queued again
+SERIAL_QUEUE_SIZE = 256 # lines waiting for a port's writer thread before writes start getting dropped
+port_io = {} # port_str -> SerialPortIO. one writer thread, outbound queue and ACK tracker per arduino, so the boards never see each others ACKs
+led_pending = {} # rack name -> {slot: (mode, hue, pos)} waiting for that rack's LED sender, newest wins
+led_frame = {} # station slot -> (mode, hue, pos) the LED manager wants it to show, sent again in full when an LED board reconnects
+led_wakeup = {} # rack name -> asyncio.Event, set when led_pending for the rack gets something
+led_resets = {} # rack name -> times its LED board was reopened (and so reset). acks from before a reset dont count
+led_refresh = asyncio.Event() # set when the LEDs might need to change: the battery index changed or one of our slot events was committed
+battery_index = BatteryIndex() # slot -> battery view kept current by the BatteryList listener (stream mode only)
+SETTINGS_CACHE_TTL = 600.0 # seconds. the listeners update the caches straight away, the TTL is only a safety net for a missed event
+NAME_CACHE_TTL = 3600.0
+settings_cache = TTLCache(maxsize=16, ttl=SETTINGS_CACHE_TTL) # Settings/* values
+name_cache = TTLCache(maxsize=4096, ttl=NAME_CACHE_TTL) # tag -> True/False, does BatteryNames/<tag> exist
+settings_listening = False # True once the Settings/minTime and BatteryNames listeners are running
+
+# === METRICS ===
+# served as GET http://127.0.0.1:9108/metrics (prometheus text format) and pushed in short form with every heartbeat, see metrics.py
+METRICS_HOST = "127.0.0.1" # local only
+METRICS_PORT = 9108 # 0 turns the endpoint off, the heartbeat still pushes the short form
+SERIAL_LINE_SECONDS = Histogram("serial_line_seconds", "Time spent handling one line read from an arduino", ["port"])
+SLOT_COMMIT_SECONDS = Histogram("slot_commit_latency_seconds", "Slot event until its firebase update went through", ["kind"])
+FIREBASE_CALL_SECONDS = Histogram("firebase_call_seconds", "Firebase call latency, tags and record numbers in the path are replaced by *", ["method", "path"])
+LED_ACK_SECONDS = Histogram("led_ack_seconds", "LED command round trip until the arduino ACKed it", ["port"])
+RETRIES = Counter("retries_total", "Retries of firebase commits and LED commands", ["kind"])
+LEDS_OUT_OF_SYNC = Counter("leds_out_of_sync_total", "LED commands that were never ACKed (LEDS OUT OF SYNC)", ["rack"])
+UNMATCHED_SLOTS = Counter("unmatched_slots_total", "Batteries put in a slot with no RFID scan to match")
+PENDING_TAGS = Gauge("pending_tags", "RFID scans waiting for a slot", function=lambda: len(pending_tags))
+COMMIT_BACKLOG = Gauge("commit_backlog", "Journaled slot events not in firebase yet", function=lambda: journal.pending_count() if journal else 0)
+SERIAL_QUEUE_DEPTH = Gauge("serial_queue_depth", "Lines waiting for a port's writer thread", ["port"],
+                           function=lambda: {(rp.id,): port_io[rp.port].metrics()["queue_depth"] for rack, rp in RACK_PORTS})
+LOOP_SECONDS = Gauge("loop_duration_seconds", "How long the last pass of each loop took", ["loop"])
+TIMER_LATENESS_SECONDS = Histogram("timer_lateness_seconds", "How late timers fired after their deadline", ["timer"],
+                                   buckets=(0.001, 0.005, 0.01, 0.02, 0.03, 0.05, 0.1, 0.25, 0.5, 1.0))
+TIMER_OVERRUNS = Counter("timer_overruns_total", "Loop passes that took longer than their interval", ["timer"])
+
+# === TIMERS ===
+# every sleep and timeout on the event loop goes through one timer wheel, deadlines in the same tick share a wakeup. see timers.py
+TIMER_TICK = 0.02 # seconds. timers fire at most about this late, never early
+timer_wheel = TimerWheel(TIMER_TICK, lateness=TIMER_LATENESS_SECONDS, overruns=TIMER_OVERRUNS)
+TIMER_WAKEUPS = Gauge("timer_wakeups", "Times the timer wheel woke the event loop", function=lambda: timer_wheel.wakeups)
+
+# === LIVE STATE API ===
+# dashboards on the shop LAN read slots, next up, port health and recent events from here instead of polling firebase, see api.py
+API_HOST = "0.0.0.0" # read only
+API_PORT = 8080 # 0 turns it off
+live = api.LiveState() # slots keyed by station slot, ports by port id, station/nextup. only touched from the event loop
+
+def metric_path(path):
+    """Firebase path with the tags and record numbers replaced by *, so the path label stays a short list."""
+    return "/".join("*" if part.isdigit() else part for part in path.strip("/").split("/")) or "/"
+
+def fb_get(path, shallow=False):
+    with FIREBASE_CALL_SECONDS.time(method="get", path=metric_path(path)):
+        return ref.child(path).get(shallow=True) if shallow else ref.child(path).get()
+
+def fb_set(path, value):
+    with FIREBASE_CALL_SECONDS.time(method="set", path=metric_path(path)):
+        ref.child(path).set(value)
+
+def fb_update(updates, path="/"):
+    with FIREBASE_CALL_SECONDS.time(method="update", path=metric_path(path)):
+        (ref.child(path) if path != "/" else ref).update(updates)
+
+# === SETUP ===
+
+def setup(hardware_file=None):
+    """Load .env, start logging, read the rack manifest and build the per port pipelines and the journal. Only does it once."""
+    global log_listener, RACKS, RACK_PORTS, STATION_SLOTS, journal, history, commit_spilled, serial_executor, led_executor, LED_PROTOCOL
+    if log_listener is not None:
+        return
+    load_dotenv()
+    log_level = getenv('LOG_LEVEL', 'INFO').upper() # set LOG_LEVEL=DEBUG in .env for the chatty logs, debug calls are close to free otherwise
+    log_listener = configure_logging(LOG_FILE, level=getattr(logging, log_level, logging.INFO), repeat_interval=LOG_REPEAT_INTERVAL)
+    LED_PROTOCOL = getenv('LED_PROTOCOL', LED_PROTOCOL).lower()
+    if LED_PROTOCOL not in ("legacy", "frame"):
+        general_log.critical(f"LED_PROTOCOL must be legacy or frame, not {LED_PROTOCOL!r}")
+        sys.exit(1)
+
+    general_log.info("Logging initialized. Program has just been started. ================ LOG START ================")
+    general_log.info("===============================================================================================")
+
+    # load the racks and the serial port IDS of their arduinos
+    # the old {"COM_PORT1": ..., "COM_PORT2": ...} file still works and is one 7 slot rack, see racks.py for the multi rack format
+    RACKS = load_manifest(hardware_file or HARDWARE_FILE)
+    RACK_PORTS = [(rack, rp) for rack in RACKS for rp in rack.ports]
+    STATION_SLOTS = [slot for rack in RACKS for slot in rack.slots]
+    general_log.info(f"Loaded racks: {RACKS}")
+    get_policy(NEXT_UP_POLICY) #a typo in the policy name should stop startup, not the LED task later
+
+    for rack, rp in RACK_PORTS:
+        port_io[rp.port] = SerialPortIO(rp.port, window=LED_WINDOW, ack_timeout=ACK_TIMEOUT, max_retries=MAX_RETRIES, queue_size=SERIAL_QUEUE_SIZE,
+                                        on_ack=functools.partial(LED_ACK_SECONDS.observe, port=rp.id))
+        port_open[rp.port] = asyncio.Event()
+        port_connected[rp.port] = asyncio.Event()
+    for rack in RACKS:
+        led_pending[rack.name] = {}
+        led_wakeup[rack.name] = asyncio.Event()
+        led_resets[rack.name] = 0
+    serial_executor = ThreadPoolExecutor(max_workers=len(RACK_PORTS), thread_name_prefix="serial-open")
+    led_executor = ThreadPoolExecutor(max_workers=len(RACKS), thread_name_prefix="led")
+    for rack in RACKS:
+        for slot in rack.slots:
+            live.set("slots", slot, {"rack": rack.name, "rack_slot": rack.local_slot(slot), "led": None, "sensor": None, "tag": None, "since": None})
+    for rack, rp in RACK_PORTS:
+        live.set("ports", rp.id, {"rack": rack.name, "role": rp.role, "port": rp.port, "open": False, "connected": False})
+
+    journal = SlotEventJournal(JOURNAL_FILE)
+    commit_spilled = journal.pending_count() > 0 #left over from last run, replayed first
+    history = ChargeHistory(HISTORY_FILE)
+    general_log.debug("CONSTANTS INITIALIZED")
+
+def init_firebase(database=None):
+    """Connect to firebase, or use `database` instead if given (anything with the db.reference() API, like fakedb.FakeDatabase for the simulator).
+    firebase_admin is only imported here, it is by far the slowest import."""
+    global db, ref, firebase_exceptions, transient_errors, data_errors, response_errors
+    from firebase_admin import exceptions
+    from google.auth import exceptions as auth_exceptions
+    import requests
+    firebase_exceptions = exceptions
+    # firebase_admin.db does not wrap everything: an offline token refresh comes out as a google.auth error, a dropped connection as requests/OSError
+    transient_errors = (exceptions.FirebaseError, auth_exceptions.TransportError, auth_exceptions.RefreshError,
+                        requests.exceptions.RequestException, OSError)
+    data_errors = (ValueError, KeyError, TypeError, requests.exceptions.InvalidJSONError) # e.g. a NaN in the update
+    response_errors = (requests.exceptions.JSONDecodeError,)
+    if database is not None:
+        db = database
+        ref = db.reference('/')
+        return
+    firebase_log.info(f"Firebase initializing.")
+    import firebase_admin
+    from firebase_admin import credentials
+    from firebase_admin import db as firebase_db
+
+    # exit the program if firebase credentials are missing
+    FIREBASE_DB_BASE_URL = getenv('FIREBASE_DB_BASE_URL')
+    FIREBASE_CREDS_FILE = getenv('FIREBASE_CREDS_FILE')
+    if not FIREBASE_DB_BASE_URL or not FIREBASE_CREDS_FILE:
+        firebase_log.critical("Missing Firebase configuration in environment variables!")
+        general_log.critical("Missing credentials. Program will not start.")
+        general_log.info("program exited with error")
+        sys.exit(1)
+
+    # Initialize the app with a service account, granting admin privileges
+    cred = credentials.Certificate(FIREBASE_CREDS_FILE)
+    firebase_log.info("Creds loaded")
+    firebase_admin.initialize_app(cred, {
+        'databaseURL': FIREBASE_DB_BASE_URL
+    })
+
+    db = firebase_db
+    ref = db.reference('/')
 
 # === UTILITY ===
 def timestamp(ts=None):
-    time_log.debug("Timestamp format set")
-    return datetime.fromtimestamp(ts or time.time()).strftime("%Y-%m-%d %H:%M:%S") #define our timestamp format
+    return format_timestamp(ts) #define our timestamp format, "%Y-%m-%d %H:%M:%S" local time. see timeutil.py
     
 
-def parse_timestamp_to_epoch(ts_str):
-    """Parse timestamp strings of format '%Y-%m-%d %H:%M:%S' to epoch seconds.
-       Return None if parsing fails."""
+async def run_blocking(func, *args, executor=None):
+    """Run a blocking call (firebase, journal fsync, LED ACK wait) on an executor thread and wait for it without blocking the loop."""
+    return await asyncio.get_running_loop().run_in_executor(executor or firebase_executor, functools.partial(func, *args))
+
+def _int_or_zero(value):
     try:
-        dt = datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S")
-        time_log.debug(f"Parsed timestamp {ts_str} to epoch. Parsing successful.")
-        return time.mktime(dt.timetuple())
-    except Exception:
-        time_log.error(f"Failed to parse timestamp")
-        return None
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+# === CACHED SETTINGS / NAMES ===
+# these change maybe once a week, so read them through the caches instead of hitting firebase every pass
+
+def get_min_time():
+    """Settings/minTime in seconds."""
+    return settings_cache.get("minTime", lambda: _int_or_zero(fb_get('Settings/minTime')))
+
+def battery_has_name(tag):
+    """True if BatteryNames/<tag> is set."""
+    return name_cache.get(tag, lambda: bool(fb_get(f'BatteryNames/{tag}')))
+
+def on_min_time_event(event):
+    """Listener for Settings/minTime, keeps the settings cache and the LED battery index current."""
+    battery_index.on_min_time_event(event)
+    if event.event_type == "put" and event.path in ("/", ""):
+        settings_cache.put("minTime", _int_or_zero(event.data))
+    else:
+        settings_cache.invalidate("minTime")
+
+def on_battery_names_event(event):
+    """Listener for BatteryNames, first event is every name, after that just the ones that changed."""
+    segments = [p for p in (event.path or "").split("/") if p]
+    if not segments:
+        if event.event_type == "put":
+            name_cache.invalidate()
+            for tag, name in (event.data or {}).items():
+                name_cache.put(tag, bool(name))
+        else:
+            for key, name in (event.data or {}).items():
+                tag = key.split("/")[0]
+                if "/" in key:
+                    name_cache.invalidate(tag)
+                else:
+                    name_cache.put(tag, bool(name))
+    elif len(segments) == 1 and event.event_type == "put":
+        name_cache.put(segments[0], bool(event.data))
+    else:
+        name_cache.invalidate(segments[0])
 
-def safe_write_serial_port_obj(ser, data):
-    """Write bytes to serial.Serial object if available. Returns True on success."""
-    if ser is None:
-        return False
+def start_cache_listeners():
+    """Subscribe to Settings/minTime and BatteryNames so the caches get invalidated as soon as something changes."""
+    global settings_listening
     try:
-        if isinstance(data, str):
-            data = data.encode('utf-8')
-        ser.write(data)
-        serial_log.debug("serial opened")
-        return True
+        listener_registrations.append(db.reference("Settings/minTime").listen(on_min_time_event))
+        listener_registrations.append(db.reference("BatteryNames").listen(on_battery_names_event))
+        settings_listening = True
+        firebase_log.info("Settings/BatteryNames listeners started")
     except Exception as e:
-        serial_log.critical(f"SERIAL WRITE ERROR {e}")
-        return False
+        firebase_log.error(f"Could not start settings listeners ({e}), cached values will refresh every {SETTINGS_CACHE_TTL:.0f}s instead")
+    return settings_listening
 
 def safe_write_serial(port, data):
-    """Thread-safe write to a serial port if present in serial_ports map."""
-    with serial_ports_lock:
-        ser = serial_ports.get(port)
-    serial_log.debug("safe write serial set")
-    return safe_write_serial_port_obj(ser, data)
+    """Queue a write on the port's own writer thread. Returns False if the port is not open."""
+    io = port_io.get(port)
+    return io.write(data) if io else False
 
 # === SERIAL HANDLER THREAD ===
 #literally just starts listening to the arduinos and when it detects a change start a match
 
-def handle_serial(Serialport):
-    ser = None
-    while True:    
-        try:
-            ser = serial.Serial(Serialport, BAUD_RATE) #opens the serial port
-            serial_log.debug(f"Serial connected at {Serialport}")
-            general_log.info("Ready")
-            time.sleep(1)
-            #publish opened serial object for other threads to use (LED manager)
-            with serial_ports_lock:
-                serial_ports[Serialport] = ser
-                serial_log.debug(f"Published serial port {Serialport} for shared use")
-            break
-        except Exception as e:
-            serial_log.critical(f"error {e} retrying in 5 seconds")
-            time.sleep(5)
+SLOT_STATES = {b"PRESENT": "PRESENT", b"REMOVED": "REMOVED"}
 
-    #keeps resending commands until the arduino recieves it.
-    while True:
-        try:
-            raw_line = ser.readline().decode("utf-8").strip()
-            serial_log.info(f"RAW LINE: '{raw_line}' from {Serialport}")
-        except Exception:
-            continue
-        
-        # --- ACK Handling ---
-        if raw_line == "ACK" or raw_line == "OK":
-            ack_received.set()
-            continue
+def parse_slot_line(line):
+    """Pull (slot, state) out of a raw line like b"12345 SLOT_0:PRESENT". Works on the bytes directly, returns None if it is not a slot line."""
+    slot_index = line.find(b"SLOT_") # Remove timestamp before SLOT_ (presently timestamp is unused)
+    if slot_index < 0:
+        return None
+    colon = line.find(b":", slot_index + 5)
+    if colon < 0:
+        return None
+    state = SLOT_STATES.get(line[colon + 1:].strip())
+    if state is None:
+        return None
+    try:
+        slot = int(line[slot_index + 5:colon])
+    except ValueError:
+        return None
+    return slot, state
+
+def open_serial_port(Serialport):
+    return serial.Serial(Serialport, BAUD_RATE, timeout=0) #non blocking, the reader waits on the file descriptor instead. no sleep here, see on_connect
+
+async def handle_serial(rack, rack_port):
+    Serialport = rack_port.port
+    io = port_io[Serialport]
+    slot_events = asyncio.Queue() #slot changes waiting to be matched/persisted, see slot_event_worker
+    worker = asyncio.create_task(slot_event_worker(rack, rack_port, slot_events), name=f"slots {rack_port.id}") if rack_port.reads_slots else None
+    loop = asyncio.get_running_loop()
+    boot_timer = None
+
+    def board_up():
+        if port_open[Serialport].is_set() and not port_connected[Serialport].is_set():
+            port_connected[Serialport].set()
+            live.merge("ports", rack_port.id, connected=True)
+            serial_log.debug("%s is up, LED writes allowed", rack_port.id)
+
+    def on_connect(ser):
+        nonlocal boot_timer
+        #publish opened serial object for other tasks to use (LED sender)
+        serial_ports[Serialport] = ser
+        io.attach(ser)
+        port_open[Serialport].set()
+        live.merge("ports", rack_port.id, open=True)
+        #opening the port resets the arduino. we read straight away, writes wait until it talks to us or ARDUINO_BOOT_SECONDS pass
+        boot_timer = loop.call_later(ARDUINO_BOOT_SECONDS, board_up)
+        if rack.led_port.port == Serialport: #the reset blanked its LEDs, so everything gets sent again once it is up
+            led_resets[rack.name] += 1
+            if LED_PROTOCOL == "frame":
+                io.led_sender.reset()
+            for slot in rack.slots:
+                last_sent_command.pop(slot, None)
+            led_pending[rack.name].update({slot: led_frame[slot] for slot in rack.slots if slot in led_frame})
+            led_wakeup[rack.name].set()
+        serial_log.debug("Published serial port %s (%s) for shared use", rack_port.id, Serialport)
+        general_log.info("Ready")
+
+    def on_disconnect():
+        #take the dead port away so nobody keeps writing into it
+        if boot_timer:
+            boot_timer.cancel()
+        port_open[Serialport].clear()
+        port_connected[Serialport].clear()
+        live.merge("ports", rack_port.id, open=False, connected=False)
+        serial_ports.pop(Serialport, None)
+        io.detach()
+        serial_log.warning("Serial port %s (%s) evicted", rack_port.id, Serialport)
+
+    line_timer = functools.partial(SERIAL_LINE_SECONDS.time, port=rack_port.id)
+
+    def on_line(raw_line):
+        with line_timer():
+            handle_line(raw_line)
+
+    def handle_line(raw_line):
+        serial_log.info("RAW LINE: %r from %s", raw_line, rack_port.id)
+        board_up() #it is talking, so it has finished booting
 
-        if raw_line == "":
-            continue
+        # --- ACK Handling ---
+        if io.on_line(raw_line): #"ACK"/"OK" or "ACK <seq> ..." only count for the port they came in on
+            return
+        if not rack_port.reads_slots:
+            return #LED only board, nothing else it says means anything to us
+
+        parsed = parse_slot_line(raw_line) # e.g. "SLOT_0:PRESENT", slot numbers are per rack
+        if parsed is None:
+            return
+        slot, state = parsed
+        if slot >= rack.slot_count:
+            serial_log.warning("%s reported SLOT_%s but %s only has %s slots", rack_port.id, slot, rack.name, rack.slot_count)
+            return
+        now = time.time() #set now to our timestamp
 
+        #just record the new state. matching and firebase happen on the slot worker
+        key = (rack.name, slot)
+        if key not in slot_status:
+            slot_status[key] = {"state": None, "last_change": 0, "tag": None} 
+        slot_status[key]["state"] = state
+        slot_status[key]["last_change"] = now 
+        live.merge("slots", rack.global_slot(slot), sensor=state)
+        slot_events.put_nowait((slot, state, now))
 
-        # Remove timestamp before SLOT_ (presently timestamp is unused)
-        if "SLOT_" not in raw_line:
-            continue
-        slot_index = raw_line.index("SLOT_")
-        line = raw_line[slot_index:]  # e.g. "SLOT_0:PRESENT"
+    #reads lines until the port goes away, then reopens it with backoff. the loop wakes up when the port has data, not on a timer
+    try:
+        await SerialReader(Serialport, open_serial_port, on_line, on_connect, on_disconnect, timers=timer_wheel).run_async(serial_executor)
+    finally:
+        if worker:
+            worker.cancel()
 
-        parts = line.replace("SLOT_", "").split(":")
-        if len(parts) != 2:
-            continue
+# === SLOT EVENT WORKER ===
+# one per sensor port so events from different arduinos (and racks) dont wait on each other. events for a slot always come from the same port so they stay in order.
 
+async def slot_event_worker(rack, rack_port, slot_events):
+    while True:
+        slot, state, now = await slot_events.get()
         try:
-            slot = int(parts[0])
-            state = parts[1]
-        except ValueError:
-            continue
-
-        now = time.time() #set now to our timestamp
-
-        with lock:
-            if slot not in slot_status:
-                slot_status[slot] = {"state": None, "last_change": 0, "tag": None} 
-
-            prev_tag = slot_status[slot]["tag"] #set previous tag
-            slot_status[slot]["state"] = state
-            slot_status[slot]["last_change"] = now 
-
             if state == "PRESENT":
-                
-                # Try to match with pending RFID tag
-                matched_tag = None
-                time.sleep(1) #wait for the keyboard input from the rfid reader to be processed, then match it with the slot.
-                
-                for tag, t_time in pending_tags:
-                    match_log.debug(f"Comparing tag time {timestamp(t_time)} to slot time {timestamp(now)}")
-                    if abs(now - t_time) <= MATCH_WINDOW_SECONDS:
-                        matched_tag = tag 
-                        match_log.info(f"Tag Pulled: {matched_tag}")
-                        break
-                if not matched_tag:
-                    match_log.warning(f"No match found for slot {slot} at {timestamp(now)} — pending_tags: {pending_tags}")
-
-                if matched_tag:
-                    match_log.info(f"Tag {matched_tag} matched to slot {slot} at {timestamp(now)}")
-                    slot_status[slot]["tag"] = matched_tag
-                    
-                    #if pending_tags changes between finding and removing it will raise value error.
-                    try:
-                        pending_tags.remove((matched_tag, t_time))
-                    except ValueError:
-                        pass
-                    
-                    #Add the newly scanned battery/tag to the 'CurrentChargingList' to show as actively charging
-                    #this could possibly be removed as i can just look at IsCharging: True. 
-                    ref.child('CurrentChargingList/' + matched_tag).update({
-                        'ID': matched_tag,
-                        'ChargingStartTime': timestamp(now), #Use this timestamp to later determine how long it's been charging for
-                    })
-                    firebase_log.debug("Added to CurrentChargingList")
-                    #Pull all records of charging for this battery/tag
-                    getCurrentChargingRecords = ref.child('BatteryList/' + matched_tag + '/ChargingRecords').get()
-
-                    if getCurrentChargingRecords is None: #Incase this is the first charge record for this battery/tag
-                      getCurrentChargingRecords = [] #create an empty array for charging records
-                      getCurrentChargingRecords.append({'StartTime': timestamp(now),'ChargingSlot': slot,'ID' : 0}) #Append the first record with the current start time and slot
-                      firebase_log.info(f"First record for {matched_tag} created")
-
-                    else: #Otherwise append a new record with the current start time and slot
-                      getCurrentChargingRecords.append({'StartTime': timestamp(now),'ChargingSlot': slot,'ID': len(getCurrentChargingRecords)})
-
-                    #Update the battery within firebase with the new charging data
-                    ref.child('BatteryList/' + matched_tag).update({
-                        'ID': matched_tag, #Battery Tag ID
-                        'ChargingRecords': getCurrentChargingRecords, #Pass in new array with appended record
-                        'IsCharging': True, #Set charging as true
-                        'ChargingSlot': slot, #Current slot the battery is charging in
-                        'ChargingStartTime': timestamp(now), #When was the most recent time it started charging - used to determine how long it's been charging for/Now time
-                        'ChargingEndTime': None, #Remove the ChargingEndTime as it's currently charging
-                        'LastChargingSlot': None, #Remove the LastChargingSlot as it's currently charging
-                    })
-                    
-                    # Check if battery has a name in BatteryNames
-                    name_ref = ref.child(f'BatteryNames/{matched_tag}')
-                    firebase_log.debug(f"Checking for name for {matched_tag}")
-                    if not name_ref.get():
-                        # Trigger the frontend to prompt naming
-                        firebase_log.debug(f"No name found for {matched_tag}, prompting for name.")
-                        ref.child(f'NameRequests/{matched_tag}').set({
-                            'Slot': slot,
-                            'Timestamp': timestamp(now),
-                            'ID': matched_tag
-                        })
-                    firebase_log.info(f"Name Exists for ID:{matched_tag}")
-
+                await match_slot_insert(rack, slot, now)
             elif state == "REMOVED":
+                prev_tag = slot_status[(rack.name, slot)]["tag"] #set previous tag
+                slot_status[(rack.name, slot)]["tag"] = None
+                live.merge("slots", rack.global_slot(slot), tag=None)
                 if prev_tag:
-                    match_log.info(f"Tag {prev_tag} removed from slot {slot} at {timestamp(now)}")
-                    slot_status[slot]["tag"] = None
-                    # Remove the newly removed battery/tag from the 'CurrentChargingList' to show as no longer actively charging
-                    ref.child('CurrentChargingList/' + prev_tag).delete() #again this could be deleted.
-                    firebase_log.info("Removed from CurrentChargingList")
-
-                    #Get the current (Now removed) charging slot for this battery/tag
-                    chargingSlot = ref.child(f'BatteryList/{prev_tag}/ChargingSlot').get()
-
-                    #Pull all records of charging for this battery/tag
-                    getCurrentChargingRecords = ref.child('BatteryList/' + prev_tag + '/ChargingRecords').get()
-
-                    #Count the number of existing records to determine the ID of the most recent record
-                    count = len(getCurrentChargingRecords) if getCurrentChargingRecords else 0 #Set to 0 if this is the first record for firebase 'array'
-                    startTime = ref.child(f'BatteryList/{prev_tag}/ChargingRecords/{count-1}/StartTime').get() #Pull the start time of the most recent record to determine duration
-                    endTime = timestamp(now) #Set the end time as now since it's just been removed
-                    endTimeStamp = timestamp(now) #Set the end time as now since it's just been removed
-                    endTime = datetime.strptime(endTime, "%Y-%m-%d %H:%M:%S") #Convert to datetime object
-                    startTime = datetime.strptime(startTime, "%Y-%m-%d %H:%M:%S") #Convert to datetime object
-                    duration = endTime - startTime #Determine the duration between start and end time 
-                    firebase_log.debug(f"Duration for {prev_tag} was {duration}")
-
-                    #Update the most recent record with the end time and duration, count-1 is used to get the most recent record since arrays are 0 indexed in Firebase
-                    ref.child(f'BatteryList/{prev_tag}/ChargingRecords/{count-1}').update({'EndTime': endTimeStamp, 'Duration': str(duration.total_seconds())[:-2]}) #Duration is saved in SECONDS with removing the default '.0' left with the total_seconds method I.E '30.0' seconds is saved as '30'
-
-                    #Remove the last record from the array to prevent it from being counted twice
-                    #This last record is the one just updated, however is currently stored locally without duration/endtime
-                    #Basically, remove the incomplete record from the local copy of the records array to then later add the completed record locally
-                    del getCurrentChargingRecords[-1]
-
-                    #Due to not waiting on confirmation from firebase that the above update has been made, manually append the end time and duration to the local copy of the records array
-                    getCurrentChargingRecords.append({'StartTime': startTime,'EndTime': endTime,'Duration': str(duration.total_seconds())[:-2]})
-                    firebase_log.info(f"Updated record for {prev_tag} with end time and duration")
-
-                    #Calculate the overall charge time and average charge time
-                    #Note, everything is in SECONDS
-                    overallDuration = 0
-                    avgDuration = 0
-                    totalCycles = 0 #Get the total number of cycles for this battery/tag
-                    minTimeSetting = ref.child(f'Settings/minTime').get() #Get the minimum time settings for the battery.
-                    firebase_log.debug(f"Pulled Minimum Time Setting {minTimeSetting} seconds")
-                    for record in getCurrentChargingRecords: #Loop through all records for this battery/tag
-                        
-                        if float(record['Duration']) >= int(minTimeSetting): #Only count records that are above the minimum time setting
-                            totalCycles += 1 #Increment the total cycles for this battery/tag
-                            overallDuration += int(record.get('Duration')) #Overall charge time is the sum of all durations in the records array
-
-                    if totalCycles > 0:    
-                      avgDuration = overallDuration/totalCycles   #Average charge time is the overall charge time divided by the number of cycles
-                      avgDuration = "{:.0f}".format(avgDuration) #Format to remove decimal places, this also rounds DOWN by removing the decimal places
-
-                    if int(str(duration.total_seconds())[:-2]) < int(minTimeSetting):
-                        ref.child('BatteryList/' + prev_tag).update({
-                        'ID': prev_tag,
-                        'IsCharging': False, #Set charging as false
-                        'ChargingSlot': None, #Remove the ChargingSlot as it's no longer charging
-                        'LastChargingSlot': chargingSlot, #Set the last charging slot to the current slot it was charging in
-                        'TotalCycles' : totalCycles, #Total number of charge cycles for this battery/tag
-                        'AverageChargeTime': avgDuration, #Average charge time in seconds
-                        'OverallChargeTime': overallDuration, #Overall lifetime charge time in seconds
-                    })
-                    else:
-                        ref.child('BatteryList/' + prev_tag).update({
-                        'ID': prev_tag,
-                        'IsCharging': False, #Set charging as false
-                        'ChargingSlot': None, #Remove the ChargingSlot as it's no longer charging
-                        'LastChargingSlot': chargingSlot, #Set the last charging slot to the current slot it was charging in
-                        'ChargingEndTime': timestamp(now), #When was the most recent time it was on a charger
-                        'ChargingStartTime': None, #Remove the ChargingStartTime as it's no longer charging
-                        'LastOverallChargeTime': str(duration.total_seconds())[:-2], #Set the last overall charge time to the duration of the most recent charge 
-                        'TotalCycles' : totalCycles, #Total number of charge cycles for this battery/tag
-                        'AverageChargeTime': avgDuration, #Average charge time in seconds
-                        'OverallChargeTime': overallDuration, #Overall lifetime charge time in seconds
-                    })
+                    match_log.info("Tag %s removed from %s slot %s at %s", prev_tag, rack.name, slot, timestamp(now))
+                    await record_slot_event({"kind": "stop", "tag": prev_tag, "slot": rack.global_slot(slot), "rack": rack.name, "time": now})
+        except Exception as e:
+            match_log.error(f"Error processing SLOT_{slot}:{state} from {rack_port.id}: {e}")
+
+async def match_slot_insert(rack, slot, now):
+    """Match a PRESENT event with a pending RFID scan and queue the firebase writes. slot is the slot number on this rack."""
+    # Try to match with pending RFID tag, the scan closest in time wins. there is one RFID reader for the whole station so scans are shared between racks
+    # returns straight away if the scan is already here, otherwise wakes up the moment listen_rfid adds one (or the window closes)
+    match = await pending_tags.wait_for_match_async(now, timer_wheel)
+    if match is None:
+        UNMATCHED_SLOTS.inc()
+        match_log.warning("No match found for %s slot %s at %s — %s scans pending", rack.name, slot, timestamp(now), len(pending_tags))
+        return
+    matched_tag, t_time = match
+    slot_status[(rack.name, slot)]["tag"] = matched_tag
+    live.merge("slots", rack.global_slot(slot), tag=matched_tag)
+    match_log.info("Tag Pulled: %s", matched_tag)
+    match_log.info("Tag %s matched to %s slot %s at %s", matched_tag, rack.name, slot, timestamp(now))
+    await record_slot_event({"kind": "start", "tag": matched_tag, "slot": rack.global_slot(slot), "rack": rack.name, "time": now}) #firebase gets the station wide slot number
+
+# === COMMITTER ===
+# every slot event goes into the journal first, then commit_loop pushes it to firebase as ONE multi-path update. each battery's events land in the order they happened, different batteries commit in parallel.
+# if firebase is unreachable the rig keeps going, events just pile up in the journal until it comes back.
+
+async def record_slot_event(event):
+    """Journal a charge start/stop and hand it to the committer. Never touches the network."""
+    global commit_spilled, last_queued_seq
+    live.add_event(event)
+    async with commit_spill_lock:
+        seq = await run_blocking(journal.append, event) #fsync, keep it off the loop
+        if commit_spilled:
+            return #older events are still waiting in the journal, this one has to go after them
+        try:
+            commit_queue.put_nowait((seq, event, False))
+            last_queued_seq = seq
+        except asyncio.QueueFull:
+            commit_spilled = True
+            firebase_log.warning("Commit queue full (%s), events will wait in the journal until firebase catches up", COMMIT_QUEUE_SIZE)
+
+async def refill_commit_queue():
+    """Move journaled events that didnt fit in commit_queue (or are left over from before a restart) back into it, oldest first."""
+    global commit_spilled, last_queued_seq
+    async with commit_spill_lock:
+        if not commit_spilled:
+            return
+        free = COMMIT_QUEUE_SIZE - commit_queue.qsize()
+        if free <= 0:
+            return
+        for seq, event in journal.pending(after_seq=last_queued_seq, limit=free): #in memory, no file read
+            commit_queue.put_nowait((seq, event, True)) #could be from before a crash that happened right after firebase took it
+            last_queued_seq = seq
+            firebase_log.info("Replaying journaled event %s: %s", seq, event)
+        if not journal.pending(after_seq=last_queued_seq, limit=1):
+            commit_spilled = False
+
+async def commit_loop():
+    """Hand events out in journal order. Different batteries commit side by side (up to COMMIT_CONCURRENCY),
+    a battery's own events are chained so its start always lands before its stop."""
+    try:
+        while True:
+            await refill_commit_queue()
+            seq, event, maybe_applied = await commit_queue.get() #sleeps until there is something to commit, no polling
+            await commit_slots.acquire()
+            tag = event.get("tag")
+            task = asyncio.create_task(commit_after(tag_commits.get(tag), seq, event, maybe_applied), name=f"commit {seq}")
+            tag_commits[tag] = task
+            task.add_done_callback(functools.partial(commit_finished, tag))
+    finally:
+        #whatever is still committing stays in the journal and gets replayed next start
+        pending = list(tag_commits.values())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+async def commit_after(previous, seq, event, maybe_applied):
+    try:
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True) #same battery, wait for its earlier event however that went
+        await commit_with_retry(seq, event, maybe_applied)
+    finally:
+        commit_slots.release()
+
+def commit_finished(tag, task):
+    if tag_commits.get(tag) is task:
+        del tag_commits[tag]
+    _log_task_exit(task)
+
+def is_bad_event(e):
+    """True if committing the event failed because of the event or its record, not firebase or the network."""
+    return isinstance(e, data_errors) and not isinstance(e, response_errors)
+
+async def commit_with_retry(seq, event, maybe_applied=False):
+    backoff = 1.0
+    while True:
+        try:
+            await run_blocking(commit_slot_event, event, maybe_applied)
+            SLOT_COMMIT_SECONDS.observe(time.time() - event["time"], kind=event["kind"])
+            led_refresh.set() #poll mode doesnt have to wait for its next poll to show it
+            await run_blocking(journal.mark_done, seq)
+            return
+        except Exception as e:
+            if is_bad_event(e): #retrying wont help
+                firebase_log.error(f"Dropping event {seq} {event}: {e!r}")
+                await run_blocking(journal.mark_done, seq)
+                return
+            #network, auth or server trouble (or something we did not expect), keep the event and try again
+            maybe_applied = True #a timed out update can still have landed
+            RETRIES.inc(kind="firebase_commit")
+            log = firebase_log.warning if isinstance(e, transient_errors) else firebase_log.error
+            log("Commit of event %s failed (%r), retrying in %.0fs. %s events waiting", seq, e, backoff, journal.pending_count())
+            await timer_wheel.sleep(backoff, "commit_retry")
+            backoff = min(backoff * 2, COMMIT_MAX_BACKOFF)
+
+def commit_slot_event(event, maybe_applied=False):
+    """Build all the writes for one event and send them as a single atomic multi-location update.
+    maybe_applied=True means an earlier attempt might have landed, so check before appending/counting again."""
+    cycle = None
+    if event["kind"] == "start":
+        updates = build_charge_start_update(event["tag"], event["slot"], event["time"], maybe_applied)
+    elif event["kind"] == "stop":
+        updates, cycle = build_charge_stop_update(event["tag"], event["slot"], event["time"], maybe_applied)
+    else:
+        raise ValueError(f"unknown event kind {event['kind']}")
+    if updates:
+        fb_update(updates) #all or nothing, so a dropped connection can never leave half a record behind
+        firebase_log.info("Committed %s for %s (%s paths)", event['kind'], event['tag'], len(updates))
+    else:
+        firebase_log.info("%s for %s was already committed, skipping", event['kind'], event['tag'])
+    if cycle and history is not None:
+        try:
+            history.add_cycle(**cycle) #after firebase took it, so the local copy never has a cycle firebase doesnt
+        except sqlite3.Error as e:
+            firebase_log.error(f"Could not write cycle for {event['tag']} to {HISTORY_FILE}: {e}")
+
+# === CHARGING RECORDS / STATS ===
+# ChargingRecords is append only: a new record is written at index RecordCount, nothing ever downloads or rewrites the whole array.
+# TotalCycles / OverallChargeTime / AverageChargeTime are running counters on the battery node, updated once per cycle.
+# Batteries from before this (no RecordCount) get rebuilt from their records the first time we see them, or all at once with --rebuild-stats.
+
+def read_battery(tag):
+    """A battery's own fields (RecordCount, the counters, ChargingStartEpoch...) in one shallow get, ChargingRecords
+    only shows up as True so it is never downloaded. Batteries that predate the counters get them rebuilt first."""
+    node = fb_get(f'BatteryList/{tag}', shallow=True)
+    if not node:
+        return {'RecordCount': 0} #never seen this battery, nothing to rebuild
+    if node.get('RecordCount') is None:
+        node.update(rebuild_battery_stats(tag))
+    return node
+
+def compute_battery_stats(records, min_time_setting):
+    """Recompute RecordCount and the cycle stats from a full ChargingRecords array/dict. Only used for migration/rebuilds."""
+    if isinstance(records, dict):
+        items = records.items()
+        record_count = max((int(k) for k in records), default=-1) + 1
+    else:
+        items = enumerate(records or [])
+        record_count = len(records or [])
+    totalCycles = 0
+    overallDuration = 0
+    for _, record in items:
+        if not isinstance(record, dict) or record.get('Duration') in (None, ''): #missing from a deleted record or one that never got closed
+            continue
+        if float(record['Duration']) >= min_time_setting: #Only count records that are above the minimum time setting
+            totalCycles += 1
+            overallDuration += int(float(record['Duration']))
+    return {
+        'RecordCount': record_count,
+        'TotalCycles': totalCycles,
+        'OverallChargeTime': overallDuration,
+        'AverageChargeTime': format_average_charge_time(overallDuration, totalCycles),
+    }
+
+def format_average_charge_time(overallDuration, totalCycles):
+    if totalCycles <= 0:
+        return 0
+    return "{:.0f}".format(overallDuration/totalCycles) #Format to remove decimal places, same format the frontend has always had
+
+def rebuild_battery_stats(tag, min_time_setting=None):
+    """One off: read a battery's whole ChargingRecords and write the running counters from it. Returns the stats written."""
+    if min_time_setting is None:
+        min_time_setting = get_min_time()
+    records = fb_get(f'BatteryList/{tag}/ChargingRecords')
+    stats = compute_battery_stats(records, min_time_setting)
+    fb_update({f'BatteryList/{tag}/{k}': v for k, v in stats.items()})
+    firebase_log.info(f"Rebuilt stats for {tag}: {stats}")
+    return stats
+
+def rebuild_all_battery_stats(tags=None):
+    """Migration command: rebuild the counters for the given tags, or every battery (one battery downloaded at a time)."""
+    min_time_setting = get_min_time()
+    if not tags:
+        tags = sorted((fb_get('BatteryList', shallow=True) or {}).keys()) #shallow, just the keys
+    for tag in tags:
+        try:
+            rebuild_battery_stats(tag, min_time_setting)
+        except Exception as e:
+            firebase_log.error(f"Failed to rebuild stats for {tag}: {e}")
+    firebase_log.info(f"Rebuilt stats for {len(tags)} batteries")
+
+def build_charge_start_update(matched_tag, slot, now, maybe_applied=False):
+    """Multi-path update for a battery going into a slot."""
+    start_ts = timestamp(now)
+    start_epoch = round(now, 3) #stored next to every time string, durations are worked out from these so DST changes cant skew them
+    battery = f'BatteryList/{matched_tag}'
+
+    node = read_battery(matched_tag)
+    if maybe_applied and node.get('ChargingStartTime') == start_ts: #this exact start already landed before a crash/timeout
+        return {}
+
+    count = int(node['RecordCount'])
+    if count == 0:
+        firebase_log.info("First record for %s created", matched_tag)
+
+    updates = {
+        #Add the newly scanned battery/tag to the 'CurrentChargingList' to show as actively charging
+        #this could possibly be removed as i can just look at IsCharging: True. 
+        f'CurrentChargingList/{matched_tag}/ID': matched_tag,
+        f'CurrentChargingList/{matched_tag}/ChargingStartTime': start_ts, #Use this timestamp to later determine how long it's been charging for
+        f'CurrentChargingList/{matched_tag}/ChargingStartEpoch': start_epoch,
+        f'{battery}/ID': matched_tag, #Battery Tag ID
+        f'{battery}/ChargingRecords/{count}': {'StartTime': start_ts,'StartEpoch': start_epoch,'ChargingSlot': slot,'ID': count}, #Append the new record by index, the rest of the array is untouched
+        f'{battery}/RecordCount': count + 1,
+        f'{battery}/IsCharging': True, #Set charging as true
+        f'{battery}/ChargingSlot': slot, #Current slot the battery is charging in
+        f'{battery}/ChargingStartTime': start_ts, #When was the most recent time it started charging - used to determine how long it's been charging for/Now time
+        f'{battery}/ChargingStartEpoch': start_epoch,
+        f'{battery}/ChargingEndTime': None, #Remove the ChargingEndTime as it's currently charging
+        f'{battery}/ChargingEndEpoch': None,
+        f'{battery}/LastChargingSlot': None, #Remove the LastChargingSlot as it's currently charging
+    }
+
+    # Check if battery has a name in BatteryNames
+    firebase_log.debug("Checking for name for %s", matched_tag)
+    if not battery_has_name(matched_tag):
+        # Trigger the frontend to prompt naming
+        firebase_log.debug("No name found for %s, prompting for name.", matched_tag)
+        updates[f'NameRequests/{matched_tag}'] = {
+            'Slot': slot,
+            'Timestamp': start_ts,
+            'ID': matched_tag
+        }
+    else:
+        firebase_log.info("Name Exists for ID:%s", matched_tag)
+    return updates
+
+def build_charge_stop_update(prev_tag, slot, now, maybe_applied=False):
+    """Multi-path update for a battery being pulled out of `slot`, and the finished cycle for the local history.
+    Returns (updates, cycle), both empty if it was already committed. One shallow read of the battery node, plus the
+    last record only when it might already be closed or the start was written before epochs were stored."""
+    battery = f'BatteryList/{prev_tag}'
+    node = read_battery(prev_tag)
+    count = int(node['RecordCount'])
+    if count == 0:
+        raise ValueError(f"{prev_tag} has no ChargingRecords to close")
+    last = f'{battery}/ChargingRecords/{count-1}' #most recent record, arrays are 0 indexed in Firebase
+
+    #the start that opened the last record wrote the same epoch to the battery node, so that is the start of this charge
+    startEpoch = None if maybe_applied else node.get('ChargingStartEpoch')
+    if startEpoch is None:
+        record = fb_get(last) or {} #one small record, never the array
+        if maybe_applied and record.get('EndTime') is not None: #already closed, dont count this cycle twice
+            return {}, None
+        #records from before epochs were stored only have the string
+        startEpoch = epoch_or_parse(record.get('StartEpoch'), record.get('StartTime'))
+    if startEpoch is None:
+        raise ValueError(f"{prev_tag} record {count-1} has no usable start time")
+    endTimeStamp = timestamp(now) #Set the end time as now since it's just been removed
+    endEpoch = round(now, 3)
+    duration = endEpoch - startEpoch #Determine the duration between start and end time, epoch seconds so a DST change in the middle doesnt matter
+    durationSeconds = format_duration(duration) #Duration is saved in whole SECONDS as a string I.E '30'
+    firebase_log.debug("Duration for %s was %ss", prev_tag, durationSeconds)
+
+    #Bump the running counters instead of looping over every record. Note, everything is in SECONDS
+    minTimeSetting = get_min_time() #Get the minimum time settings for the battery.
+    firebase_log.debug("Minimum Time Setting %s seconds", minTimeSetting)
+    totalCycles = int(node.get('TotalCycles') or 0)
+    overallDuration = int(node.get('OverallChargeTime') or 0)
+    counted = int(durationSeconds) >= minTimeSetting #Only count records that are above the minimum time setting
+    if counted:
+        totalCycles += 1
+        overallDuration += int(durationSeconds)
+
+    updates = {
+        # Remove the newly removed battery/tag from the 'CurrentChargingList' to show as no longer actively charging
+        f'CurrentChargingList/{prev_tag}': None, #again this could be deleted.
+        #Update the most recent record with the end time and duration
+        f'{last}/EndTime': endTimeStamp,
+        f'{last}/EndEpoch': endEpoch,
+        f'{last}/Duration': durationSeconds,
+        f'{battery}/ID': prev_tag,
+        f'{battery}/IsCharging': False, #Set charging as false
+        f'{battery}/ChargingSlot': None, #Remove the ChargingSlot as it's no longer charging
+        f'{battery}/LastChargingSlot': slot, #Set the last charging slot to the current slot it was charging in
+        f'{battery}/TotalCycles': totalCycles, #Total number of charge cycles for this battery/tag
+        f'{battery}/AverageChargeTime': format_average_charge_time(overallDuration, totalCycles), #Average charge time in seconds
+        f'{battery}/OverallChargeTime': overallDuration, #Overall lifetime charge time in seconds
+    }
+    if counted:
+        updates.update({
+            f'{battery}/ChargingEndTime': endTimeStamp, #When was the most recent time it was on a charger
+            f'{battery}/ChargingEndEpoch': endEpoch,
+            f'{battery}/ChargingStartTime': None, #Remove the ChargingStartTime as it's no longer charging
+            f'{battery}/ChargingStartEpoch': None,
+            f'{battery}/LastOverallChargeTime': durationSeconds, #Set the last overall charge time to the duration of the most recent charge 
+        })
+    cycle = {"tag": prev_tag, "record": count - 1, "slot": slot, "start": startEpoch, "end": endEpoch,
+             "duration": int(durationSeconds), "counted": counted}
+    return updates, cycle
 
 #ALEX DO NOT USE .SET ANYMORE ONLY USE .UPDATE YOU PMO - Jackson 8/7/2025
 
 
-# === RFID LISTENER THREAD ===
+# === RFID LISTENER ===
 # essentially all this does is look for a 10 digit string of numbers coming in from the keyboard. if it detects it, add it to pending_tags.
 
-def listen_rfid():
+def read_rfid_lines(source, loop, lines):
+    """Runs on its own daemon thread and hands every line to the loop, b"" once the input is gone.
+    A plain blocking readline() on purpose: making stdin non-blocking would make the tty the console log writes to
+    non-blocking as well, and log lines would get dropped (and the terminal left that way after exit)."""
+    def feed(line):
+        try:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+            return True
+        except RuntimeError: #the loop is closed, we are shutting down
+            return False
+    try:
+        for line in iter(source.readline, b""):
+            if not feed(line):
+                return
+    except (ValueError, OSError) as e:
+        rfid_log.critical(f"Cannot read RFID input: {e}")
+    feed(b"")
+
+async def listen_rfid(source=None):
+    """Read tag scans from the keyboard wedge on stdin (or `source`, any binary pipe/tty file object, the simulator uses this)."""
+    loop = asyncio.get_running_loop()
+    if source is None:
+        try: #unbuffered, a daemon thread stuck inside sys.stdin.buffer's lock makes the interpreter abort on exit
+            source = open(sys.stdin.fileno(), "rb", buffering=0, closefd=False)
+        except (AttributeError, ValueError, OSError) as e:
+            rfid_log.critical(f"Cannot read RFID input from stdin: {e}")
+            return
+    lines = asyncio.Queue()
+    threading.Thread(target=read_rfid_lines, args=(source, loop, lines), name="rfid", daemon=True).start() #daemon, a readline() waiting on the keyboard must not hold up exit
+    rfid_ready.set()
     while True:
-        tag_buffer = input().strip() #read the input and add it to a buffer variable
-        rfid_log.info(f"Input Received, added to buffer: {tag_buffer}")
+        line = await lines.get()
+        if not line:
+            rfid_log.critical("RFID input closed, no more tags will be read")
+            return
+        tag_buffer = line.decode("utf-8", "replace").strip() #read the input and add it to a buffer variable
+        rfid_log.info("Input Received, added to buffer: %s", tag_buffer)
         if tag_buffer.isdigit() and len(tag_buffer) >= 10: #if its a valid tag scan, not just someone typing
             tag_id = tag_buffer[-10:] 
             now = time.time()
-            with lock:
-                pending_tags.append((tag_id, now)) #timestamp the tag scan and send it off to be matched with a slot <3
-                rfid_log.info(f"Tag Read: {tag_id} at {timestamp(now)}")
+            pending_tags.add(tag_id, now) #timestamp the tag scan and send it off to be matched with a slot <3
+            rfid_log.info("Tag Read: %s at %s", tag_id, timestamp(now))
         else:
-            rfid_log.warning(f"Ignored invalid input: {tag_buffer}") #log it
+            rfid_log.warning("Ignored invalid input: %s", tag_buffer) #log it
             tag_buffer = "" #clear the buffer
 
-# === LED MANAGER THREAD ===
+# === LED MANAGER ===
 
-def led_manager_loop():
-    last_heartbeat = 0.0 #restart heartbeat
-    led_log.debug("Heartbeat reset")
+def start_battery_listeners():
+    """Subscribe the battery index to BatteryList (minTime comes from the settings listener).
+    The first event is a full snapshot, after that firebase only streams what changed.
+    Returns False if the stream could not be opened so the caller can fall back to polling."""
+    if not settings_listening:
+        firebase_log.error(f"Settings listener is not running, falling back to polling every {POLL_INTERVAL}s")
+        return False
+    try:
+        listener_registrations.append(db.reference("BatteryList").listen(battery_index.on_battery_event))
+        firebase_log.info("BatteryList listener started, LEDs running in stream mode")
+        return True
+    except Exception as e:
+        firebase_log.error(f"Could not start BatteryList listener ({e}), falling back to polling every {POLL_INTERVAL}s")
+        return False
 
-    while True:
-        with serial_ports_lock:
-            ser = serial_ports.get(COM_PORT1) #we have to share the com port so we are just waiting for the parent function (handle_serial) to open the serial interface
-        if ser:
-            break
-        led_log.debug("Waiting for COM_PORT1 to be opened by handle_serial...")
-        time.sleep(0.5) #dont spam
+def start_stream_listeners():
+    """Try stream mode again after falling back to polling, settings listeners first if they never started."""
+    if not settings_listening:
+        start_cache_listeners()
+    return start_battery_listeners()
+
+def build_slot_to_battery(batteries):
+    """Build slot -> (tag, battery_data) from a full BatteryList download (poll mode)."""
+    slot_to_battery = {}
+    for tag, data in batteries.items():
+        if not isinstance(data, dict): 
+            continue
+        if data.get("IsCharging") and data.get("ChargingSlot") is not None: #if its currently charging
+            slot_to_battery[data["ChargingSlot"]] = (tag, data)
+            led_log.debug("Battery %s in slot %s is charging", tag, data['ChargingSlot'])
+    return slot_to_battery
+
+LED_STYLES = { # renderer state -> (mode, hue)
+    "AVAILABLE": ("PULSE", HUE_ORANGE), #slot is available
+    "CHARGING": ("SOLID", HUE_RED), #currently charging
+    "CHARGED": ("SOLID", HUE_BLUE), #charged, but not the best available
+    "NEXT": ("DEEPPULSE", HUE_GREEN), #pick this next
+}
 
-    def wait_for_ack(timeout=ACK_TIMEOUT):
-        ack_received.clear()
-        led_log.debug("Waiting for ACK...")
-        return ack_received.wait(timeout=timeout)
+async def led_manager_loop():
+    """Work out what changed on every rack and hand it to each rack's LED sender.
+    The renderer keeps the last frame, so a pass only looks at slots the battery index marked dirty and minTime
+    crossings that came due. In stream mode this sleeps until one of those happens, an idle station costs nothing.
+    Poll mode polls every POLL_INTERVAL while things change and backs off to POLL_IDLE_INTERVAL when they dont,
+    but never sleeps past the next minTime crossing.
+    The slow part (writing frames and waiting for ACKs) happens on the per rack senders, so racks update in parallel."""
+    loop = asyncio.get_running_loop()
+    battery_index.add_listener(lambda: loop.call_soon_threadsafe(led_refresh.set)) #the index is fed from firebase's listener thread
+    use_stream = LED_UPDATE_MODE == "stream" and await run_blocking(start_battery_listeners)
+    renderer = FrameRenderer(STATION_SLOTS, policy=NEXT_UP_POLICY)
+    slot_rack = {slot: rack for rack in RACKS for slot in rack.slots}
+    quiet_polls = 0 # poll mode, polls in a row where nothing changed
+    poll_backoff = POLL_IDLE_INTERVAL # poll mode, wait before the next try after a failed poll. doubles up to COMMIT_MAX_BACKOFF
+    next_up_retry = None # seconds until BatteryNextUp is tried again after a failed write, None while it is up to date
 
     while True:
         loop_start = time.time()
+        led_refresh.clear() #clear before reading so a change that lands mid-render wakes us straight back up
 
-        if (time.time() - last_heartbeat) >= HEARTBEAT_INTERVAL:
-            safe_write_serial(COM_PORT1, "PING\n")
-            last_heartbeat = time.time()
-            led_log.debug("PING sent") 
-
-        try:
-            min_time_setting = int(ref.child('Settings/minTime').get() or 0) #pull min time setting for rendering the LEDS
-        except Exception:
-            min_time_setting = 0
-
-        with lock:
-            local_slot_status = dict(slot_status)
-
-        #Pull charging status directly from BatteryList
-        batteries_ref = db.reference("BatteryList") 
-        batteries = batteries_ref.get() or {} 
+        if use_stream and not battery_index.loaded: #the first snapshots come later on firebase's thread, an empty index would light every slot up as available
+            await timer_wheel.wait(led_refresh, None, "led_manager")
+            continue
 
-        # Build mapping of slot -> (tag, battery_data)
-        slot_to_battery = {}
-        for tag, data in batteries.items():
-            if not isinstance(data, dict): 
+        if use_stream:
+            changes, min_time_setting, full = battery_index.take_changes()
+        else:
+            try:
+                min_time_setting = await run_blocking(get_min_time) #min time setting for rendering the LEDS
+            except Exception:
+                min_time_setting = 0
+
+            #Pull charging status directly from BatteryList
+            try:
+                batteries = await run_blocking(fb_get, "BatteryList") or {}
+            except Exception as e: #firebase or the network is down, the LEDs keep showing the last frame until it is back
+                RETRIES.inc(kind="led_poll")
+                firebase_log.error(f"Could not poll BatteryList ({e}), trying again in {poll_backoff:.1f}s")
+                await timer_wheel.sleep(poll_backoff, "led_poll_retry")
+                poll_backoff = min(poll_backoff * 2, COMMIT_MAX_BACKOFF)
+                if LED_UPDATE_MODE == "stream": #we only poll because the stream would not start, maybe it will now
+                    use_stream = await run_blocking(start_stream_listeners)
                 continue
-            if data.get("IsCharging") and data.get("ChargingSlot") is not None: #if its currently charging
-                slot_to_battery[data["ChargingSlot"]] = (tag, data)
-                led_log.info(f"Battery {tag} in slot {data['ChargingSlot']} is charging")
-
-        # Iterate through all slots
-        slot_evaluations = {}
-        for slot in range(7):
-            entry = {"state": "AVAILABLE", "tag": None, "elapsed": None}
-            if slot in slot_to_battery:
-                tag, bdata = slot_to_battery[slot]
-                entry["state"] = "PRESENT"
-                entry["tag"] = tag
-                cst = bdata.get("ChargingStartTime")
-                epoch = parse_timestamp_to_epoch(cst) if cst else None
-                if epoch:
-                    entry["elapsed"] = time.time() - epoch
-            slot_evaluations[slot] = entry
-
-        
-        pickNextSlot(slot_evaluations, min_time_setting)
-        nextup = pickNextSlot(slot_evaluations, min_time_setting)
-        led_log.info(f"Next slot to pick: {nextup}")
-
-        
-        
-
-        for slot in range(7):
-            ev = slot_evaluations[slot]
-            if ev["state"] == "AVAILABLE":
-                mode, hue = "PULSE", HUE_ORANGE #slot is available
-            elif ev["state"] == "PRESENT":
-                if ev["elapsed"] and ev["elapsed"] >= min_time_setting:
-                    if slot == nextup:
-                        mode, hue = "DEEPPULSE", HUE_GREEN #pick this next
-                    else:
-                        mode, hue = "SOLID", HUE_BLUE #charged, but not the best available
-                else:
-                    mode, hue = "SOLID", HUE_RED #currently charging
-            else:
-                mode, hue = "PULSE", HUE_ORANGE #i dont think this matters but it makes the code look cooler
-
-            pos = POSITIONS[slot] if slot < len(POSITIONS) else 0
-            this_cmd = (mode, hue, pos)
-            last = last_sent_command.get(slot)
-
-            if this_cmd != last: #just make sure we are not repeating commands
-                cmd_str = f"SEG {slot} POS {pos} COLOR {hue} MODE {mode}\n" #sets the command format
-                retries = 0
-                while retries < MAX_RETRIES: #retry logic
-                    if safe_write_serial(COM_PORT1, cmd_str):
-                        led_log.info(f"Sent: {cmd_str.strip()} (attempt {retries+1})")
-                        if wait_for_ack():
-                            last_sent_command[slot] = this_cmd
-                            break
-                        else:
-                            retries += 1
-                            led_log.warning(f"No ACK received for slot {slot}, retrying ({retries}/{MAX_RETRIES})...")
-                            time.sleep(0.2)
-                    else:
-                        led_log.error(f"Failed to send command for slot {slot}")
-                        break
-                if retries >= MAX_RETRIES:
-                    led_log.critical(f"Failed to confirm slot {slot} command after {MAX_RETRIES} attempts. Critical error, LEDs may be out of sync.")
-                    led_log.warning("LEDS OUT OF SYNC")
-
-            time.sleep(0.1)
+            poll_backoff = POLL_IDLE_INTERVAL
+
+            # Build mapping of slot -> (tag, battery_data)
+            changes, full = build_slot_to_battery(batteries), True
+
+        now = time.time()
+        previous_nextup = renderer.nextup
+        changed_states = renderer.render(changes, min_time_setting, now, full) #one pick for the whole station, the best battery might be on any rack
+        for slot in changed_states.keys() | (changes.keys() & renderer.slots):
+            tag, since = renderer.battery(slot)
+            live.merge("slots", slot, led=renderer.frame.get(slot), tag=tag, since=since)
+        if renderer.nextup != previous_nextup:
+            live.set("station", "nextup", {"tag": renderer.nextup_tag(), "slot": renderer.nextup} if renderer.nextup is not None else None)
+        if changed_states:
+            led_log.debug("Slots changed: %s, next slot to pick: %s", changed_states, renderer.nextup)
+            per_rack = {}
+            for slot, state in changed_states.items():
+                rack = slot_rack[slot]
+                mode, hue = LED_STYLES[state]
+                per_rack.setdefault(rack.name, {})[slot] = led_frame[slot] = (mode, hue, rack.position(rack.local_slot(slot)))
+            for name, changed in per_rack.items():
+                led_pending[name].update(changed)
+                led_wakeup[name].set()
+        if renderer.nextup is not None and (renderer.nextup_tag(), renderer.nextup) != last_next_up:
+            if await run_blocking(publish_next_up, renderer.nextup_tag(), renderer.nextup):
+                next_up_retry = None
+            else: #nothing else may wake us for a long time in stream mode, so come back for it. doubles up to COMMIT_MAX_BACKOFF
+                RETRIES.inc(kind="next_up")
+                next_up_retry = TIMER_TICK if next_up_retry is None else min(max(next_up_retry * 2, 1.0), COMMIT_MAX_BACKOFF)
+        else:
+            next_up_retry = None
 
         elapsed = time.time() - loop_start
-        sleep_time = max(0, POLL_INTERVAL - elapsed)
-        time.sleep(sleep_time)
-
-def pickNextSlot(slot_evaluations, min_time_setting):
-    fully_charged = [
-        (s, e["elapsed"]) for s, e in slot_evaluations.items()
-        if e["state"] == "PRESENT" and e["elapsed"] and e["elapsed"] >= min_time_setting
-    ]
+        LOOP_SECONDS.set(elapsed, loop="led_manager")
+        #nothing else can change what the LEDs show until the index changes or the next battery crosses minTime
+        deadline = renderer.next_deadline()
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        if not use_stream:
+            quiet_polls = 0 if changed_states else quiet_polls + 1
+            interval = POLL_INTERVAL if quiet_polls < POLL_IDLE_AFTER else POLL_IDLE_INTERVAL #someone else could change BatteryList, so keep polling
+            timeout = max(0, interval - elapsed) if timeout is None else min(timeout, max(0, interval - elapsed))
+        if next_up_retry is not None:
+            timeout = next_up_retry if timeout is None else min(timeout, next_up_retry)
+        await timer_wheel.wait(led_refresh, timeout, "led_manager")
+
+async def led_sender_loop(rack):
+    """One per rack: PINGs the rack's LED board and sends whatever the LED manager queued for it.
+    Segments that never got acked are queued again after LED_RESEND_DELAY unless a newer command for the slot came first."""
+    led_port = rack.led_port
+    connected = port_connected[led_port.port]
+    pending = led_pending[rack.name]
+    wakeup = led_wakeup[rack.name]
+    unconfirmed = {} # slot -> command sent but never acked
+    resend_at = None
+    last_heartbeat = 0.0 #restart heartbeat
+    led_log.debug("Heartbeat reset")
 
-    if not fully_charged:
-        led_log.info("No fully charged slots available.")
-        return None
+    while True:
+        if not connected.is_set(): #handle_serial opens the port, we just wait for it. queued changes stay in led_pending until it is back
+            led_log.debug("Waiting for %s to be opened by handle_serial...", led_port.id)
+            await connected.wait()
+
+        if not pending:
+            timeout = max(0, last_heartbeat + HEARTBEAT_INTERVAL - time.time())
+            if resend_at is not None:
+                timeout = min(timeout, max(0, resend_at - time.time()))
+            await timer_wheel.wait(wakeup, timeout, "led_ping")
+        wakeup.clear()
+        if resend_at is not None and time.time() >= resend_at:
+            for slot, cmd in unconfirmed.items():
+                pending.setdefault(slot, cmd) #a newer command for the slot wins
+            unconfirmed.clear()
+            resend_at = None
+        changed = {slot: cmd for slot, cmd in pending.items() if cmd != last_sent_command.get(slot)}
+        for slot in pending:
+            unconfirmed.pop(slot, None) #superseded, whatever was queued now is what the slot should show
+        pending.clear()
 
-    pick_next_slot = max(fully_charged, key=lambda x: x[1])[0]
-    tag = slot_evaluations[pick_next_slot]["tag"]
-    led_log.info(f"Next slot to pick: {pick_next_slot} (Tag: {tag})")
+        if (time.time() - last_heartbeat) >= HEARTBEAT_INTERVAL:
+            safe_write_serial(led_port.port, "PING\n")
+            last_heartbeat = time.time()
+            led_log.debug("PING sent to %s", led_port.id) 
 
+        if changed:
+            resets = led_resets[rack.name]
+            if LED_PROTOCOL == "frame":
+                acked = await run_blocking(send_led_frame, rack, changed, executor=led_executor) #blocks on ACKs, which the serial reader task feeds in
+            else:
+                acked = set()
+                for slot, this_cmd in changed.items():
+                    if await send_led_segment_legacy(rack, slot, this_cmd):
+                        acked.add(slot)
+                    await timer_wheel.sleep(0.1, "led_legacy_gap")
+            if led_resets[rack.name] == resets: #otherwise the board was reset meanwhile and on_connect queued the whole frame again
+                for slot in acked:
+                    last_sent_command[slot] = changed[slot]
+            unconfirmed.update({slot: cmd for slot, cmd in changed.items() if last_sent_command.get(slot) != cmd})
+            if unconfirmed and resend_at is None:
+                resend_at = time.time() + LED_RESEND_DELAY
+
+def send_led_frame(rack, changed):
+    """Send every changed segment on one rack in one pipelined batch, only unacked segments get resent.
+    Returns the station slots that were acked, the caller records them in last_sent_command on the loop."""
+    #the arduino counts its own slots from 0, so the wire uses the rack's slot numbers
+    sender = port_io[rack.led_port.port].led_sender
+    retransmits = sender.retransmits
+    acked, failed = sender.send({rack.local_slot(slot): (pos, hue, mode) for slot, (mode, hue, pos) in changed.items()})
+    led_log.info("Sent LED frame to %s for slots %s, acked %s", rack.name, sorted(changed), sorted(rack.global_slot(s) for s in acked))
+    if sender.retransmits > retransmits:
+        RETRIES.inc(sender.retransmits - retransmits, kind="led_frame")
+    if failed:
+        LEDS_OUT_OF_SYNC.inc(len(failed), rack=rack.name)
+        led_log.critical(f"Failed to confirm {rack.name} slots {sorted(rack.global_slot(s) for s in failed)} after {MAX_RETRIES} attempts. Critical error, LEDs may be out of sync.")
+        led_log.warning("LEDS OUT OF SYNC")
+    return {rack.global_slot(local) for local in acked}
+
+async def send_led_segment_legacy(rack, slot, this_cmd):
+    """Old stop and wait protocol, one SEG line and one bare ACK at a time. Waiting for the ACK happens on led_executor.
+    Returns True once the board acked it."""
+    mode, hue, pos = this_cmd
+    cmd_str = f"SEG {rack.local_slot(slot)} POS {pos} COLOR {hue} MODE {mode}\n" #sets the command format
+    retries = 0
+    while retries < MAX_RETRIES: #retry logic
+        sent_at = time.monotonic()
+        acked = await run_blocking(port_io[rack.led_port.port].send_and_wait_ack, cmd_str, ACK_TIMEOUT, executor=led_executor)
+        if acked is not None:
+            led_log.info("Sent to %s: %s (attempt %s)", rack.name, cmd_str.strip(), retries+1)
+            if acked:
+                LED_ACK_SECONDS.observe(time.monotonic() - sent_at, port=rack.led_port.id)
+                return True
+            else:
+                retries += 1
+                RETRIES.inc(kind="led_legacy")
+                led_log.warning("No ACK received for slot %s, retrying (%s/%s)...", slot, retries, MAX_RETRIES)
+                await timer_wheel.sleep(0.2, "led_retry")
+        else:
+            led_log.error(f"Failed to send command for slot {slot}")
+            break
+    if retries >= MAX_RETRIES:
+        LEDS_OUT_OF_SYNC.inc(rack=rack.name)
+        led_log.critical(f"Failed to confirm slot {slot} command after {MAX_RETRIES} attempts. Critical error, LEDs may be out of sync.")
+        led_log.warning("LEDS OUT OF SYNC")
+    return False
+
+def publish_next_up(tag, slot):
+    """Write BatteryNextUp, only called when the pick changed. Returns False if it failed, the LED manager tries again shortly."""
+    global last_next_up
+    led_log.info("Next slot to pick: %s (Tag: %s)", slot, tag)
     try:
-        ref.child("BatteryNextUp").set({
+        fb_set("BatteryNextUp", {
             "BatteryNext": tag,
-            "Slot": pick_next_slot
+            "Slot": slot
         })
+        last_next_up = (tag, slot)
         led_log.info("Updated Firebase: BatteryNextUp")
+        return True
     except Exception as e:
         led_log.error(f"Failed to update BatteryNextUp: {e}")
+        return False
+
+THERMAL_FILE = "/sys/class/thermal/thermal_zone0/temp"
+thermal_fd = None # opened once, sysfs gives a fresh value every time it is read from offset 0
 
-    return pick_next_slot
+def read_cpu_temp():
+    """Pi CPU temperature in C, None when there is no thermal zone (not a pi, e.g. running the simulator)."""
+    global thermal_fd
+    try:
+        if thermal_fd is None:
+            thermal_fd = os.open(THERMAL_FILE, os.O_RDONLY)
+        return round(int(os.pread(thermal_fd, 16, 0)) / 1000, 1)
+    except (OSError, ValueError):
+        return None
 
-def heartbeat_loop():
+async def heartbeat_loop():
     """Periodically check serial connections and update Firebase /status."""
     STATUS_INTERVAL = 10.0  # seconds
-    firebase_log.info("Heartbeat thread started.")
+    firebase_log.info("Heartbeat task started.")
 
     while True:
-        with serial_ports_lock:
-            ports_snapshot = dict(serial_ports)
-
-        status_data = {
-            "COM_PORT1": "connected" if COM_PORT1 in ports_snapshot else "disconnected",
-            "COM_PORT2": "connected" if COM_PORT2 in ports_snapshot else "disconnected",
-            "CPU_Temp": round(float(open("/sys/class/thermal/thermal_zone0/temp").read()) / 1000, 1),
+        pass_start = time.time()
+        started = time.monotonic()
+        ports_snapshot = dict(serial_ports)
+
+        status_data = {rp.id: "connected" if rp.port in ports_snapshot else "disconnected" for rack, rp in RACK_PORTS} #keyed by port id, COM_PORT1/COM_PORT2 with the old hardwareIDS.json
+        status_data.update({
+            "CPU_Temp": read_cpu_temp(),
+            "StartupSeconds": ready_seconds,
+            "Metrics": metrics.REGISTRY.compact(), #counters, gauges and p50/p95 of the histograms, the full set is on METRICS_PORT
             "LastUpdated": timestamp()
-        }
+        })
 
         try:
-            ref.child("status").update(status_data)
+            await run_blocking(fb_update, status_data, "status")
             firebase_log.info(f"Heartbeat update: {status_data}")
         except Exception as e:
             firebase_log.error(f"Failed to update Firebase status: {e}")
 
-        time.sleep(STATUS_INTERVAL)
-
+        for rack, rp in RACK_PORTS:
+            serial_log.info(f"Port {rp.id} ({rack.name}, {rp.role}): {port_io[rp.port].metrics()}")
+        match_log.info(f"Tag matcher: {pending_tags.stats()}")
 
-# === MAIN ===
+        LOOP_SECONDS.set(time.time() - pass_start, loop="heartbeat")
+        await timer_wheel.sleep_until_next("heartbeat", started, STATUS_INTERVAL) #every 10s from the start of each pass, not 10s after it finished
 
-if __name__ == "__main__":
-    threading.Thread(target=handle_serial, args=(COM_PORT1,), daemon=True).start() #args is now the com port for each arduino, kept in hardwareIDS.json. This is so we can listen to both arduinos
-    threading.Thread(target=handle_serial, args=(COM_PORT2,), daemon=True).start()
 
-    # Start the LED manager thread (reads DB and writes LED commands using the same COM_PORT1 serial object)
-    threading.Thread(target=led_manager_loop, daemon=True).start()
-    threading.Thread(target=heartbeat_loop, daemon=True).start()
+# === MAIN ===
 
-    listen_rfid()
+def _log_task_exit(task):
+    #a task that dies on its own is a bug, make sure it at least shows up in the log
+    if not task.cancelled() and task.exception() is not None:
+        general_log.critical(f"Task {task.get_name()} crashed: {task.exception()!r}")
+
+async def start_tasks(rfid_source=None, database=None):
+    """Start every task on the running loop and return them. The serial ports and the RFID reader start straight away,
+    firebase connects on an executor thread at the same time and the tasks that need it start once it is up."""
+    setup()
+    tasks = [asyncio.create_task(handle_serial(rack, rack_port), name=f"serial {rack_port.id}") for rack, rack_port in RACK_PORTS] #one reader per arduino, kept in hardwareIDS.json. This is so we can listen to every arduino on every rack
+    tasks.append(asyncio.create_task(listen_rfid(rfid_source), name="rfid"))
+    tasks.append(asyncio.create_task(wait_until_ready(), name="ready"))
+    if METRICS_PORT:
+        tasks.append(asyncio.create_task(metrics.serve(METRICS_HOST, METRICS_PORT), name="metrics"))
+    if API_PORT:
+        tasks.append(asyncio.create_task(api.serve(API_HOST, API_PORT, live), name="api"))
+    for task in tasks:
+        task.add_done_callback(_log_task_exit)
+
+    #scans and slot events that come in before this is done get matched and journaled, the committer picks them up when it starts
+    await run_blocking(init_firebase, database)
+    await run_blocking(start_cache_listeners)
+    firebase_ready.set()
+
+    later = [asyncio.create_task(commit_loop(), name="commit")] #firebase writes for slot events, replays anything left in the journal first
+    # LED manager (reads DB and works out the LED commands) and one sender per rack (writes them using the serial object handle_serial opened)
+    later.append(asyncio.create_task(led_manager_loop(), name="led manager"))
+    later += [asyncio.create_task(led_sender_loop(rack), name=f"led {rack.name}") for rack in RACKS]
+    later.append(asyncio.create_task(heartbeat_loop(), name="heartbeat"))
+    for task in later:
+        task.add_done_callback(_log_task_exit)
+    return tasks + later
+
+async def wait_until_ready():
+    """Log how long after the process started the station could take a scan and commit it."""
+    global ready_seconds
+    sensor_ports = [port_open[rp.port].wait() for rack, rp in RACK_PORTS if rp.reads_slots]
+    await asyncio.gather(rfid_ready.wait(), firebase_ready.wait(), *sensor_ports)
+    ready_seconds = round(time.monotonic() - _process_start, 3)
+    general_log.info("Ready for scans %.3fs after start", ready_seconds)
+
+async def stop_tasks(tasks):
+    """Cancel the tasks, close ports and listeners, let an in-flight commit finish."""
+    global thermal_fd
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True) #serial ports get closed in the readers' finally blocks
+    for registration in listener_registrations:
+        registration.close()
+    # an in-flight commit finishes, anything not marked done is still in the journal and gets replayed next start
+    firebase_executor.shutdown(wait=True)
+    led_executor.shutdown(wait=False, cancel_futures=True)
+    serial_executor.shutdown(wait=False, cancel_futures=True)
+    if thermal_fd is not None:
+        os.close(thermal_fd)
+        thermal_fd = None
+    general_log.info("Stopped")
+
+async def run():
+    """Run every task on one event loop until SIGINT/SIGTERM, then shut down cleanly."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    tasks = await start_tasks()
+    await stop.wait()
+    general_log.info("Shutting down")
+    await stop_tasks(tasks)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    setup()
+    if "--rebuild-stats" in argv: #one time migration: python3 input_listener.py --rebuild-stats [TAG ...]
+        init_firebase()
+        rebuild_all_battery_stats(argv[argv.index("--rebuild-stats") + 1:])
+        return 0
+
+    asyncio.run(run())
+    return 0
 
-    # Keep alive
-    while True:
-        time.sleep(1)
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Append-only write-ahead journal for slot events.
+
+Every charge start/stop is written (and fsync'd) here before we try to push it
+to Firebase, and a "done" marker is appended once Firebase has it. If the
+network drops or the Pi loses power, whatever is not marked done gets replayed
+on the next startup.
+
+File format is one JSON object per line:
+    {"seq": 12, "event": {...}}   an event waiting to be committed
+    {"done": 12}                  event 12 made it to Firebase
+"""
+import json
+import os
+import threading
+
+
+class SlotEventJournal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = {}  # seq -> event, everything appended but not marked done yet
+        self._next_seq = 1
+        created = not os.path.exists(self.path)
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+        if created:
+            self._fsync_dir()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        complete = 0  # bytes up to the end of the last whole line
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # torn write from a power cut, its append never returned so nobody is counting on it
+                complete += len(line)
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue  # garbage inside a whole line, the events around it are still good
+                if "seq" in item:
+                    self._pending[item["seq"]] = item["event"]
+                    self._next_seq = max(self._next_seq, item["seq"] + 1)
+                elif "done" in item:
+                    self._pending.pop(item["done"], None)
+            torn = f.seek(0, os.SEEK_END) > complete
+        if torn:
+            # cut the fragment off, otherwise the next append gets glued onto it and that event is unreadable next time
+            with open(self.path, "r+b") as f:
+                f.truncate(complete)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _write(self, item):
+        self._file.write(json.dumps(item, separators=(",", ":")) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, event):
+        """Durably record an event. Returns its sequence number."""
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._write({"seq": seq, "event": event})
+            self._pending[seq] = event
+            return seq
+
+    def mark_done(self, seq):
+        """Record that `seq` was committed. Truncates the file once nothing is outstanding."""
+        with self._lock:
+            if self._pending.pop(seq, None) is None:
+                return
+            if self._pending:
+                self._write({"done": seq})
+            else:
+                # everything is committed, start the file over so it doesnt grow forever
+                self._file.close()
+                self._file = open(self.path, "w", encoding="utf-8")
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._fsync_dir()
+
+    def _fsync_dir(self):
+        # the file's directory entry and size only survive a power cut once the directory is synced too
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def pending(self, after_seq=0, limit=None):
+        """Return [(seq, event)] not yet committed with seq > after_seq, oldest first."""
+        with self._lock:
+            items = sorted((s, e) for s, e in self._pending.items() if s > after_seq)
+        return items[:limit] if limit is not None else items
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
@@ -0,0 +1,164 @@
+"""Batched, pipelined LED command protocol.
+
+The old protocol sends one "SEG <slot> POS <pos> COLOR <hue> MODE <mode>" line,
+waits up to ACK_TIMEOUT for a bare "ACK"/"OK", and only then sends the next
+slot. Any ACK counts for whatever command is waiting, so a late one from a
+previous command gets credited to the wrong slot.
+
+Here every segment gets a sequence number and as many as fit in the window go
+out at once, packed into short frames:
+
+    F 12:0,3,170,D 13:1,11,0,S 14:2,18,25,P\\n      (seq:slot,pos,hue,mode)
+
+The Arduino answers with the sequence numbers it applied, e.g. "ACK 12 13 14"
+(spaces or commas). Only segments that are still unacked after ack_timeout get
+resent. ACKs for sequence numbers we are not waiting on are counted as stale and
+otherwise ignored.
+"""
+import threading
+import time
+
+MODE_CODES = {"PULSE": "P", "DEEPPULSE": "D", "SOLID": "S"}
+MAX_FRAME_BYTES = 60  # keep each line inside the arduino's 64 byte serial buffer
+SEQ_MODULO = 65536
+
+
+class _Segment:
+    __slots__ = ("slot", "text", "attempts", "deadline")
+
+    def __init__(self, slot, text):
+        self.slot = slot
+        self.text = text
+        self.attempts = 0
+        self.deadline = 0.0
+
+
+def encode_segment(seq, slot, pos, hue, mode):
+    return f"{seq}:{slot},{pos},{hue},{MODE_CODES.get(mode, mode)}"
+
+
+def pack_frames(segment_texts, max_bytes=MAX_FRAME_BYTES):
+    """Pack encoded segments into as few "F ..." lines as fit in max_bytes each."""
+    frames = []
+    line = "F"
+    for text in segment_texts:
+        if line != "F" and len(line) + 1 + len(text) + 1 > max_bytes:  # +1 for the space, +1 for the newline
+            frames.append(line + "\n")
+            line = "F"
+        line += " " + text
+    if line != "F":
+        frames.append(line + "\n")
+    return frames
+
+
+def parse_ack(line):
+    """Return the sequence numbers in an "ACK 12 13,14" line, or None if it is not a sequenced ACK."""
+    if not line.startswith("ACK "):
+        return None
+    seqs = []
+    for part in line[4:].replace(",", " ").split():
+        if not part.isdigit():
+            return None
+        seqs.append(int(part))
+    return seqs or None
+
+
+class LedFrameSender:
+    """Sliding window sender for one LED board. `write` is a callable(str) -> bool that puts a line on the wire.
+    `on_ack(seconds)`, if given, gets the round trip of every acked segment (measured from its last transmission)."""
+
+    def __init__(self, write, window=8, ack_timeout=2.0, max_retries=5, on_ack=None):
+        self.write = write
+        self.on_ack = on_ack
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._next_seq = 1
+        self._inflight = {}  # seq -> _Segment, sent but not acked yet
+        self._acked = set()  # slots acked during the current send()
+        self._failed = set()  # slots the current send() gave up on
+        self.sent_segments = 0
+        self.retransmits = 0
+        self.stale_acks = 0
+
+    def on_line(self, line):
+        """Feed a line read from the board. Returns True if it was a sequenced ACK (so the caller can skip it)."""
+        seqs = parse_ack(line)
+        if seqs is None:
+            return False
+        with self._cond:
+            for seq in seqs:
+                seg = self._inflight.pop(seq, None)
+                if seg is None:
+                    self.stale_acks += 1  # late ACK for a retransmit or an older send(), nothing waiting on it
+                else:
+                    self._acked.add(seg.slot)
+                    if self.on_ack:
+                        self.on_ack(time.monotonic() - (seg.deadline - self.ack_timeout))
+            self._cond.notify_all()
+        return True
+
+    def reset(self):
+        """The board was reset (its port was reopened): forget what is in flight and what was acked and start the
+        sequence numbers over. A send() still waiting counts the segments it had out as failed, and whatever the
+        old board acked is not reported, the new one never saw it."""
+        with self._cond:
+            self._failed.update(seg.slot for seg in self._inflight.values())
+            self._inflight.clear()
+            self._acked = set()
+            self._next_seq = 1
+            self._cond.notify_all()
+
+    def _take_seq(self):
+        seq = self._next_seq
+        self._next_seq = self._next_seq % (SEQ_MODULO - 1) + 1
+        return seq
+
+    def send(self, segments):
+        """Send {slot: (pos, hue, mode)} and block until every segment is acked or out of retries.
+        Returns (acked_slots, failed_slots)."""
+        todo = [(slot, segments[slot]) for slot in sorted(segments)]
+        with self._cond:
+            self._inflight.clear()  # anything still waiting from a previous send is superseded
+            self._acked = set()
+            self._failed = failed = set()
+            while todo or self._inflight:
+                now = time.monotonic()
+                outgoing = []
+
+                # retransmit only what timed out
+                for seq, seg in list(self._inflight.items()):
+                    if seg.deadline > now:
+                        continue
+                    if seg.attempts >= self.max_retries:
+                        del self._inflight[seq]
+                        failed.add(seg.slot)
+                        continue
+                    self.retransmits += 1
+                    outgoing.append((seq, seg))
+
+                # then top the window up with new segments
+                while todo and len(self._inflight) < self.window:
+                    slot, (pos, hue, mode) = todo.pop(0)
+                    seq = self._take_seq()
+                    seg = _Segment(slot, encode_segment(seq, slot, pos, hue, mode))
+                    self._inflight[seq] = seg
+                    outgoing.append((seq, seg))
+
+                if outgoing:
+                    for seq, seg in outgoing:
+                        seg.attempts += 1
+                        seg.deadline = now + self.ack_timeout
+                    self.sent_segments += len(outgoing)
+                    for frame in pack_frames(seg.text for _, seg in outgoing):
+                        if not self.write(frame):  # port is gone, no point waiting for ACKs
+                            failed.update(seg.slot for seg in self._inflight.values())
+                            failed.update(slot for slot, _ in todo)
+                            self._inflight.clear()
+                            return set(self._acked), set(failed)
+
+                if self._inflight:
+                    next_deadline = min(seg.deadline for seg in self._inflight.values())
+                    self._cond.wait(max(0.0, next_deadline - time.monotonic()))
+            return set(self._acked), set(failed)
@@ -0,0 +1,125 @@
+"""Differential LED rendering: keep the last frame and only recompute the slots that changed.
+
+The LED manager used to work out every slot on every rack and re-pick the next
+battery on every pass. FrameRenderer remembers which battery is in each slot and
+what state the slot was last shown in, and only looks at dirty slots: the ones
+the battery index says changed, the ones that just crossed minTime, and the
+old/new "next up" slot. minTime crossings sit in a heap keyed by when they
+happen, so the caller sleeps until the next one instead of re-checking elapsed
+times, and a pass where nothing changed costs nothing. Charged batteries go in
+a next_up.NextUpQueue ordered by the selection policy.
+
+States are "AVAILABLE", "CHARGING", "CHARGED" and "NEXT", turning them into
+colours is up to the caller.
+"""
+import heapq
+
+from next_up import NextUpQueue, get_policy
+from timeutil import epoch_or_parse
+
+
+def start_epoch(fields):
+    """Charge start of a battery, already worked out by the battery index in stream mode, parsed (memoised) in poll mode."""
+    epoch = fields.get("_start_epoch")
+    if epoch is None:
+        epoch = epoch_or_parse(fields.get("ChargingStartEpoch"), fields.get("ChargingStartTime"))
+    return epoch
+
+
+class FrameRenderer:
+    def __init__(self, slots, policy="longest_rested"):
+        self.slots = frozenset(slots)
+        self.policy = get_policy(policy)
+        self.min_time = None
+        self.frame = {}        # slot -> state it is showing
+        self.nextup = None     # slot of the battery to take next, picked by the policy
+        self._batteries = {}   # slot -> (tag, start epoch or None, policy key)
+        self._charged = NextUpQueue()  # batteries past minTime
+        self._crossings = []   # heap of (epoch the battery crosses minTime, slot, its start epoch)
+        self._dirty = set(self.slots)  # everything gets drawn once
+
+    def next_deadline(self):
+        """Epoch of the next minTime crossing, or None. Can be early if that battery left since, render() just skips it."""
+        return self._crossings[0][0] if self._crossings else None
+
+    def nextup_tag(self):
+        return self._batteries[self.nextup][0] if self.nextup is not None else None
+
+    def battery(self, slot):
+        """(tag, charge start epoch) of the battery in slot, (None, None) if it is empty."""
+        battery = self._batteries.get(slot)
+        return (battery[0], battery[1]) if battery else (None, None)
+
+    def render(self, changes, min_time, now, full=False):
+        """Apply {slot: (tag, fields) or None} for the slots that changed and return {slot: state} for the
+        slots whose LEDs have to change. With full=True changes is the whole slot -> battery map."""
+        dirty = self._dirty
+        for slot in (self.slots | self._batteries.keys()) if full else changes:
+            if slot not in self.slots:
+                continue  # not one of our racks
+            entry = changes.get(slot)
+            battery = self._battery(*entry) if entry else None
+            if battery != self._batteries.get(slot):
+                if battery is None:
+                    del self._batteries[slot]
+                else:
+                    self._batteries[slot] = battery
+                self._schedule(slot, now)
+                dirty.add(slot)
+
+        if min_time != self.min_time:  # every threshold moved, start over
+            self.min_time = min_time
+            self._crossings = []
+            self._charged.clear()
+            for slot in self._batteries:
+                self._schedule(slot, now)
+            dirty.update(self.slots)
+
+        while self._crossings and self._crossings[0][0] <= now:
+            _, slot, start = heapq.heappop(self._crossings)
+            battery = self._batteries.get(slot)
+            if battery is not None and battery[1] == start:  # skip it if the battery was swapped since
+                self._charged.push(slot, battery[2])
+                dirty.add(slot)
+
+        if not dirty:
+            return {}
+
+        nextup = self._charged.best()  # station wide, lowest slot on a tie
+        if nextup != self.nextup:
+            dirty.update(s for s in (self.nextup, nextup) if s is not None)
+            self.nextup = nextup
+
+        changed = {}
+        for slot in dirty:
+            state = self._state(slot)
+            if state != self.frame.get(slot):
+                self.frame[slot] = changed[slot] = state
+        dirty.clear()
+        return changed
+
+    def _battery(self, tag, fields):
+        start = start_epoch(fields)
+        return (tag, start, self.policy(tag, start, fields) if start else None)
+
+    def _schedule(self, slot, now):
+        """Put the battery in slot into _charged or the crossings heap."""
+        self._charged.discard(slot)
+        battery = self._batteries.get(slot)
+        if battery is None or not battery[1] or self.min_time is None:
+            return  # no start time shows as charging, same as always
+        start = battery[1]
+        crosses = start + self.min_time
+        if crosses <= now and now > start:
+            self._charged.push(slot, battery[2])
+        else:
+            heapq.heappush(self._crossings, (crosses, slot, start))
+
+    def _state(self, slot):
+        if slot not in self._batteries:
+            return "AVAILABLE"
+        if slot == self.nextup:
+            return "NEXT"
+        if slot in self._charged:
+            return "CHARGED"
+        return "CHARGING"
@@ -0,0 +1,105 @@
+"""Logging pipeline: callers only drop records on a queue, one background thread formats and writes them.
+
+On an SD card Pi the synchronous RotatingFileHandler + ColorFormatter used to
+run inside the serial, LED and RFID threads for every record. Now those threads
+just put the record on a queue (QueueHandler) and a QueueListener thread does
+the formatting and the file/console I/O. Identical messages repeated in a short
+window are collapsed into one line with a count.
+"""
+import atexit
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
+
+
+# Color-coded console handler
+class ColorFormatter(logging.Formatter):
+    COLORS = {
+        "FIREBASE": "\033[96m",  # cyan
+        "LED": "\033[93m",       # yellow
+        "RFID": "\033[92m",      # green
+        "SERIAL": "\033[95m",    # magenta
+        "TIME": "\033[94m",      # blue
+        "MATCH PROCESS": "\033[91m",  # red
+        "GENERAL": "\033[97m",   # white
+    }
+    RESET = "\033[0m"
+
+    def format(self, record):
+        color = self.COLORS.get(record.name, "\033[97m")
+        formatted = super().format(record)
+        return f"{color}{formatted}{self.RESET}"
+
+
+class RepeatFilter(logging.Filter):
+    """Drop a message if the exact same one (same logger, level and text) was let through less than `interval` seconds ago.
+    The next time it gets through it says how many copies were skipped.
+    Runs on whichever thread logged the record, so the bookkeeping is behind a lock."""
+
+    def __init__(self, interval=30.0, max_keys=512):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self._seen = OrderedDict()  # (name, level, message) -> [last_emitted, suppressed_count]
+        self.suppressed = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True  # never hide errors
+        message = record.getMessage()  # formatting stays outside the lock
+        key = (record.name, record.levelno, message)
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                self.suppressed += 1
+                return False
+            repeated = seen[1] if seen is not None else 0
+            self._seen[key] = [now, 0]
+            self._seen.move_to_end(key)
+            if len(self._seen) > self.max_keys:
+                self._seen.popitem(last=False)
+        if repeated:
+            record.msg = f"{message} (repeated {repeated} more times)"
+            record.args = None
+        return True
+
+
+def configure_logging(log_file="log.txt", level=logging.INFO, console_level=logging.INFO, repeat_interval=30.0, stream=None):
+    """Point the root logger at a queue and start the listener thread that does the real I/O. Returns the listener."""
+    # Rotating file handler (keeps last 5 logs, each up to 5MB)
+    file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=5, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    file_handler.setLevel(level)
+
+    console_handler = logging.StreamHandler(stream or sys.stdout)
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(ColorFormatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    if repeat_interval:
+        queue_handler.addFilter(RepeatFilter(repeat_interval))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)  # records below this are never even created, so debug calls cost next to nothing
+    root_logger.addHandler(queue_handler)
+
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging, listener)  # flush whatever is still queued on the way out
+    return listener
+
+
+def stop_logging(listener):
+    """Flush the queue and stop the listener thread. Safe to call more than once."""
+    if listener._thread is not None:
+        listener.stop()
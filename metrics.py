@@ -0,0 +1,218 @@
+"""Counters, gauges and histograms for the hot paths, served in the Prometheus text format.
+
+No prometheus_client dependency, this is the small subset we need: metrics with
+optional labels, fixed bucket histograms, gauges that are read from a function
+at scrape time, a text rendering for GET /metrics on a local port (serve()) and
+a compact dict that fits in the heartbeat's Firebase /status update.
+"""
+import asyncio
+import bisect
+import logging
+import threading
+import time
+
+general_log = logging.getLogger("GENERAL")
+
+# seconds. serial parsing is microseconds, firebase and LED ACKs are tens of ms to seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"expected labels {labelnames}, got {sorted(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()  # observed from the loop and from executor threads
+        self._values = {}
+        (registry or REGISTRY).register(self)
+
+    def _render_samples(self):
+        for key, value in sorted(self._items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+    def _items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + list(self._render_samples()))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def compact(self):
+        return self.total()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), registry=None, function=None):
+        super().__init__(name, help, labelnames, registry)
+        self._function = function  # called at scrape time, returns the value (or {label tuple: value} with labels)
+
+    def set(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _items(self):
+        if self._function is None:
+            return super()._items()
+        try:
+            value = self._function()
+        except Exception:
+            return []
+        return list(value.items()) if self.labelnames else [((), value)]
+
+    def compact(self):
+        items = [(key, round(value, 4) if isinstance(value, float) else value) for key, value in self._items()]
+        if not self.labelnames:
+            return items[0][1] if items else None
+        return {"_".join(key): value for key, value in items}
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # per bucket counts (+Inf last), sum, count
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """with hist.time(path=...): ... observes how long the block took."""
+        return _Timer(self, labels)
+
+    def _render_samples(self):
+        for key, (counts, total, count) in sorted(self._items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile from the buckets (upper bound of the bucket it falls in), all label sets merged unless labels are given.
+        Past the last bucket the answer is the last bucket's bound, a lower bound that still fits in JSON."""
+        items = self._items()
+        if labels:
+            key = _label_key(self.labelnames, labels)
+            items = [(k, v) for k, v in items if k == key]
+        counts = [0] * (len(self.buckets) + 1)
+        for _, (series_counts, _, _) in items:
+            counts = [a + b for a, b in zip(counts, series_counts)]
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def compact(self):
+        count = sum(series[2] for _, series in self._items())
+        if not count:
+            return {"count": 0}
+        return {"count": count, "p50_ms": round(self.quantile(0.5) * 1000, 1), "p95_ms": round(self.quantile(0.95) * 1000, 1)}
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        if any(m.name == metric.name for m in self._metrics):
+            raise ValueError(f"metric {metric.name} already registered")
+        self._metrics.append(metric)
+
+    def render(self):
+        """Prometheus text exposition format."""
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+    def compact(self):
+        """{name: value} small enough for the heartbeat /status update. Histograms become count/p50/p95."""
+        return {m.name: m.compact() for m in self._metrics}
+
+
+REGISTRY = Registry()
+
+
+async def serve(host, port, registry=None):
+    """Answer GET /metrics on host:port until cancelled."""
+    registry = registry or REGISTRY
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5.0)
+            while (await asyncio.wait_for(reader.readline(), 5.0)) not in (b"\r\n", b"\n", b""):
+                pass  # skip the headers
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/metrics", b"/"):
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    general_log.info("Metrics on http://%s:%s/metrics", host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,93 @@
+"""Which charged battery goes next: selection policies and the heap they are kept in.
+
+A policy turns a charged battery into a sort key, smallest goes first (the
+slot number breaks ties). The LED renderer pushes a battery into NextUpQueue
+when it crosses minTime and drops it when it leaves its slot, so picking is a
+heap peek instead of a scan over every slot on every rack.
+
+    longest_rested   charged the longest (oldest charge start). what the station always did
+    least_cycled     fewest TotalCycles first, spreads wear across the fleet
+    fastest_charger  lowest AverageChargeTime first
+
+New policies: decorate a function (tag, start epoch, battery fields) -> tuple with @policy("name").
+Anything the key reads from the battery fields has to be in battery_index.RELEVANT_FIELDS for stream mode.
+"""
+import heapq
+
+POLICIES = {}
+
+
+def policy(name):
+    def register(func):
+        POLICIES[name] = func
+        return func
+    return register
+
+
+def get_policy(name):
+    try:
+        return POLICIES[name]
+    except KeyError:
+        raise ValueError(f"unknown next up policy {name!r}, expected one of {sorted(POLICIES)}") from None
+
+
+def _number(value, default):
+    # TotalCycles is an int, AverageChargeTime has always been a string of whole seconds (or 0)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+@policy("longest_rested")
+def longest_rested(tag, start, fields):
+    return (start,)
+
+
+@policy("least_cycled")
+def least_cycled(tag, start, fields):
+    return (_number(fields.get("TotalCycles"), 0.0), start)
+
+
+@policy("fastest_charger")
+def fastest_charger(tag, start, fields):
+    average = _number(fields.get("AverageChargeTime"), 0.0)
+    return (average if average > 0 else float("inf"), start)  # no average yet goes after the ones we know
+
+
+class NextUpQueue:
+    """Slots of charged batteries, ordered by their policy key. push O(log n), discard O(1), best() amortised O(log n).
+
+    Removed or re-pushed slots are left in the heap and skipped when they reach the top."""
+
+    def __init__(self):
+        self._heap = []
+        self._live = {}  # slot -> the heap entry that is current for it
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, slot):
+        return slot in self._live
+
+    def push(self, slot, key):
+        entry = (key, slot)
+        self._live[slot] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._live) + 32:  # mostly dead entries, start over
+            self._heap = list(self._live.values())
+            heapq.heapify(self._heap)
+
+    def discard(self, slot):
+        self._live.pop(slot, None)
+
+    def clear(self):
+        self._heap = []
+        self._live.clear()
+
+    def best(self):
+        """Slot to take next, or None."""
+        heap = self._heap
+        while heap and self._live.get(heap[0][1]) is not heap[0]:
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
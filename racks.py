@@ -0,0 +1,117 @@
+"""Rack manifest: which Arduinos belong to which charging rack, what they do and where the slots sit.
+
+hardwareIDS.json used to be exactly {"COM_PORT1": ..., "COM_PORT2": ...} for one
+7 slot rack. It can now list any number of racks:
+
+    {"racks": [
+        {"name": "rack1",
+         "first_slot": 0,
+         "slots": 7,
+         "positions": [3, 11, 18, 26, 34, 42, 49],
+         "ports": [
+             {"id": "COM_PORT1", "port": "/dev/serial/by-id/...", "role": "both"},
+             {"id": "COM_PORT2", "port": "/dev/serial/by-id/...", "role": "sensor"}]}]}
+
+Roles: "sensor" boards report SLOT_n lines, "led" boards take the LED commands,
+"both" does both. Every rack needs exactly one board that drives its LEDs.
+The Arduinos still count their slots from 0, first_slot is added on top, so the
+ChargingSlot stored in Firebase is unique across the whole station. The old two
+port file still loads as one rack with slots 0-6.
+"""
+import json
+
+DEFAULT_POSITIONS = [3, 11, 18, 26, 34, 42, 49]  # where the leftmost LED of each slot is on the original 7 slot rack
+ROLES = ("sensor", "led", "both")
+
+
+class RackPort:
+    def __init__(self, port_id, port, role):
+        self.id = port_id   # short name used for logs and the /status keys (device paths are not valid firebase keys)
+        self.port = port    # device path
+        self.role = role
+
+    @property
+    def reads_slots(self):
+        return self.role in ("sensor", "both")
+
+    @property
+    def drives_leds(self):
+        return self.role in ("led", "both")
+
+
+class Rack:
+    def __init__(self, name, first_slot, slot_count, positions, ports):
+        self.name = name
+        self.first_slot = first_slot
+        self.slot_count = slot_count
+        self.positions = positions
+        self.ports = ports
+        self.led_port = next(p for p in ports if p.drives_leds)
+
+    @property
+    def slots(self):
+        """Station wide slot numbers of this rack."""
+        return range(self.first_slot, self.first_slot + self.slot_count)
+
+    def global_slot(self, local_slot):
+        return self.first_slot + local_slot
+
+    def local_slot(self, slot):
+        return slot - self.first_slot
+
+    def position(self, local_slot):
+        return self.positions[local_slot] if local_slot < len(self.positions) else 0
+
+    def __repr__(self):
+        return f"Rack({self.name!r}, slots {self.first_slot}-{self.first_slot + self.slot_count - 1}, ports {[p.id for p in self.ports]})"
+
+
+def parse_manifest(manifest):
+    """Turn the loaded hardwareIDS.json into a list of Racks. Raises ValueError if it doesn't make sense."""
+    if "racks" not in manifest:  # old format, one rack with both arduinos reading slots and COM_PORT1 on the LEDs
+        manifest = {"racks": [{
+            "name": "rack1",
+            "ports": [
+                {"id": "COM_PORT1", "port": manifest["COM_PORT1"], "role": "both"},
+                {"id": "COM_PORT2", "port": manifest["COM_PORT2"], "role": "sensor"},
+            ],
+        }]}
+
+    racks = []
+    names = set()
+    port_paths = set()
+    next_slot = 0
+    for i, entry in enumerate(manifest["racks"]):
+        name = entry.get("name") or f"rack{i + 1}"
+        if name in names:
+            raise ValueError(f"rack name {name!r} is used twice")
+        names.add(name)
+
+        positions = list(entry.get("positions") or DEFAULT_POSITIONS)
+        slot_count = int(entry.get("slots", len(positions)))
+        first_slot = int(entry.get("first_slot", next_slot))  # default: carry on numbering after the previous rack
+        if first_slot < next_slot:
+            raise ValueError(f"rack {name!r} slots start at {first_slot} but the previous rack goes up to {next_slot - 1}")
+        next_slot = first_slot + slot_count
+
+        ports = []
+        for j, p in enumerate(entry.get("ports") or []):
+            role = p.get("role", "both")
+            if role not in ROLES:
+                raise ValueError(f"rack {name!r} port {p.get('port')!r} has unknown role {role!r}")
+            if p["port"] in port_paths:
+                raise ValueError(f"port {p['port']!r} is listed twice")
+            port_paths.add(p["port"])
+            ports.append(RackPort(p.get("id") or f"{name}_port{j + 1}", p["port"], role))
+        led_ports = [p for p in ports if p.drives_leds]
+        if len(led_ports) != 1:
+            raise ValueError(f"rack {name!r} needs exactly one port with role 'led' or 'both', found {len(led_ports)}")
+        racks.append(Rack(name, first_slot, slot_count, positions, ports))
+    if not racks:
+        raise ValueError("no racks configured")
+    return racks
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return parse_manifest(json.load(f))
@@ -0,0 +1,257 @@
+"""Per-port serial I/O: writer thread, outbound queue, ACK correlator and counters per Arduino,
+plus a non-blocking line reader that reconnects by itself.
+
+Before this there was one global ack_received Event that any "ACK"/"OK" line
+from either board would set, and whichever thread wanted to write just wrote to
+the port. Now each port owns its writes and its ACKs, so driving LEDs on two
+boards at once can't cross wires, and a chatty sensor board can't produce
+phantom ACKs for the LED board.
+
+The reader used to be a blocking readline() with no timeout, and a pulled cable
+turned into a 100% CPU loop that never reopened the port. SerialReader runs on
+the asyncio loop with the fd registered through loop.add_reader(), so an idle
+port costs nothing. It frames lines in one reused bytearray, reopens the port
+with backoff when it goes away, and opens it on an executor thread (opening
+resets the arduino and takes a second). A pulled cable shows up as a hangup on
+the fd, which makes the read fail with EIO (or return EOF), so there is no
+timer checking that the device node still exists. The reconnect backoff runs on
+the caller's TimerWheel.
+"""
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+
+from led_protocol import LedFrameSender
+from timers import TimerWheel
+
+serial_log = logging.getLogger("SERIAL")
+
+
+class SerialPortIO:
+    def __init__(self, port, window=8, ack_timeout=2.0, max_retries=5, queue_size=256, on_ack=None):
+        self.port = port
+        self._ser = None
+        self._outbound = queue.Queue(maxsize=queue_size)
+        self._ack_event = threading.Event()  # bare "ACK"/"OK" from this port only (legacy protocol)
+        self.led_sender = LedFrameSender(self.write, window=window, ack_timeout=ack_timeout, max_retries=max_retries, on_ack=on_ack)
+        self.stats = {
+            "lines_in": 0,
+            "lines_out": 0,
+            "bytes_out": 0,
+            "acks": 0,
+            "write_errors": 0,
+            "dropped_writes": 0,
+        }
+        self._writer = threading.Thread(target=self._writer_loop, name=f"serial-writer {port}", daemon=True)
+        self._writer.start()
+
+    # --- connection ---
+
+    def attach(self, ser):
+        """Start writing to an opened serial.Serial."""
+        self._ser = ser
+
+    def detach(self):
+        self._ser = None
+
+    @property
+    def connected(self):
+        return self._ser is not None
+
+    # --- output ---
+
+    def write(self, data):
+        """Queue a line for this port's writer thread. Returns False if the port is not open or the queue is full."""
+        if self._ser is None:
+            return False
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        try:
+            self._outbound.put_nowait(data)
+            return True
+        except queue.Full:
+            self.stats["dropped_writes"] += 1
+            serial_log.error(f"Outbound queue for {self.port} is full, dropping {data!r}")
+            return False
+
+    def send_and_wait_ack(self, data, timeout):
+        """Legacy stop and wait: write one command and wait for a bare ACK/OK from this port."""
+        self._ack_event.clear()  # clear before writing so a fast ACK can't slip in between
+        if not self.write(data):
+            return None  # never went out
+        return self._ack_event.wait(timeout=timeout)
+
+    def _writer_loop(self):
+        while True:
+            data = self._outbound.get()
+            ser = self._ser
+            if ser is None:
+                self.stats["dropped_writes"] += 1
+                continue
+            try:
+                ser.write(data)
+                self.stats["lines_out"] += 1
+                self.stats["bytes_out"] += len(data)
+            except Exception as e:
+                self.stats["write_errors"] += 1
+                serial_log.critical(f"SERIAL WRITE ERROR on {self.port}: {e}")
+                time.sleep(0.1)  # dont spin if the port just died, the reader will reconnect it
+
+    # --- input ---
+
+    def on_line(self, line):
+        """Feed a line (bytes) read from this port. Returns True if it was an ACK (so the caller can stop processing it)."""
+        self.stats["lines_in"] += 1
+        if line == b"ACK" or line == b"OK":
+            self.stats["acks"] += 1
+            self._ack_event.set()
+            return True
+        if line.startswith(b"ACK ") and self.led_sender.on_line(line.decode("ascii", "replace")):
+            self.stats["acks"] += 1
+            return True
+        return False
+
+    def metrics(self):
+        m = dict(self.stats)
+        m["queue_depth"] = self._outbound.qsize()
+        m["connected"] = self.connected
+        m["led_segments_sent"] = self.led_sender.sent_segments
+        m["led_retransmits"] = self.led_sender.retransmits
+        m["stale_acks"] = self.led_sender.stale_acks
+        return m
+
+
+class LineFramer:
+    """Splits a byte stream into lines using one bytearray that is reused for the life of the port."""
+
+    def __init__(self, max_line=512):
+        self.max_line = max_line
+        self._buf = bytearray()
+        self.overflows = 0
+
+    def feed(self, data):
+        """Add raw bytes, return the complete lines (bytes, no trailing \\r\\n) they finished."""
+        buf = self._buf
+        buf += data
+        lines = []
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            line_end = end - 1 if end > start and buf[end - 1] == 13 else end  # drop the \r the arduino's println adds
+            if line_end > start:
+                lines.append(bytes(buf[start:line_end]))
+            start = end + 1
+        if start:
+            del buf[:start]
+        if len(buf) > self.max_line:  # no newline in sight, this is noise. throw it away instead of growing forever
+            self.overflows += 1
+            buf.clear()
+        return lines
+
+    def reset(self):
+        self._buf.clear()
+
+
+class FdSerial:
+    """Minimal serial-like wrapper around a raw file descriptor (a pty for testing without an arduino)."""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SerialReader:
+    """Read lines from one port forever, reopening it with backoff whenever it disappears.
+
+    opener(port) returns an open serial-like object with fileno()/write()/close().
+    on_connect(ser) / on_disconnect() let the caller publish and evict the port,
+    on_line(bytes) gets every complete line. timers is the TimerWheel the reconnect backoff sleeps on.
+    """
+
+    def __init__(self, port, opener, on_line, on_connect=None, on_disconnect=None,
+                 timers=None, min_backoff=0.5, max_backoff=30.0, max_line=512):
+        self.port = port
+        self.opener = opener
+        self.on_line = on_line
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.timers = timers or TimerWheel()
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.framer = LineFramer(max_line)
+        self.reconnects = 0
+
+    async def run_async(self, executor=None):
+        """Read until cancelled, the port is closed on the way out."""
+        loop = asyncio.get_running_loop()
+        backoff = self.min_backoff
+        while True:
+            try:
+                ser = await loop.run_in_executor(executor, self.opener, self.port)
+            except Exception as e:
+                serial_log.critical(f"Could not open {self.port}: {e}. retrying in {backoff:.1f} seconds")
+                await self.timers.sleep(backoff, "serial_reopen")
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            connected_at = time.monotonic()
+            serial_log.info(f"Serial connected at {self.port}")
+            if self.on_connect:
+                self.on_connect(ser)
+            try:
+                await self._read_until_gone_async(ser, loop)
+            finally:
+                if self.on_disconnect:
+                    self.on_disconnect()
+                try:
+                    ser.close()
+                except Exception:
+                    pass
+                self.framer.reset()
+            self.reconnects += 1
+            if time.monotonic() - connected_at > self.max_backoff:
+                backoff = self.min_backoff  # it was up for a while, this is a fresh failure not a flapping port
+            serial_log.critical(f"Lost {self.port}, reconnecting in {backoff:.1f} seconds")
+            await self.timers.sleep(backoff, "serial_reopen")
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def _read_until_gone_async(self, ser, loop):
+        fd = ser.fileno()
+        gone = loop.create_future()
+
+        def readable():
+            try:
+                data = os.read(fd, 4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                serial_log.critical(f"Read error on {self.port}: {e}")
+                data = b""
+            if not data:  # EOF or error (EIO once the usb device is gone), the other end hung up
+                loop.remove_reader(fd)
+                if not gone.done():
+                    gone.set_result(None)
+                return
+            for line in self.framer.feed(data):
+                try:
+                    self.on_line(line)
+                except Exception as e:  # a bad line must not take the reader down with it
+                    serial_log.error(f"Error handling {line!r} from {self.port}: {e}")
+
+        loop.add_reader(fd, readable)  # a hangup wakes this too, the read then fails
+        try:
+            await gone
+        finally:
+            loop.remove_reader(fd)
@@ -0,0 +1,311 @@
+"""Run the whole input_listener pipeline without arduinos, an RFID reader or firebase.
+
+Every port in a generated rack manifest is a pseudo terminal: the simulator
+writes SLOT_n lines into the sensor boards' ptys, answers LED frames with ACKs
+like the arduino code does, and types tag scans into a pipe that listen_rfid
+reads instead of stdin. Firebase is fakedb.FakeDatabase. The real
+handle_serial / listen_rfid / committer / LED tasks run unchanged on top.
+
+A script is one event per line, "<seconds> <source> <payload>", where source is
+RFID or a port id from the manifest:
+
+    0.000 RFID 0000000001
+    0.010 rack1_sensor 10 SLOT_0:PRESENT
+    5.000 rack1_sensor 5000 SLOT_0:REMOVED
+
+    python3 simulator.py [--events N] [--racks R] [--slots S] [--latency SEC] [--speed X] [--replay FILE] [--save FILE] [--fleet EXPORT] [--json]
+
+--fleet starts the fake database from an NDJSON export of the real BatteryList (export.py).
+
+input_listener keeps its state in module globals, so this runs one simulation per process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pty
+import random
+import sys
+import tempfile
+import time
+import tty
+
+from fakedb import FakeDatabase
+from serial_io import FdSerial, LineFramer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def synthetic_script(racks=1, slots=7, events=200, gap=0.05, scan_lead=0.01, seed=1):
+    """Fill every slot, then keep pulling a random charged battery and putting a new one in.
+    Returns [(t, source, payload)]. Scans come scan_lead before their PRESENT, inserts gap apart."""
+    rng = random.Random(seed)
+    script = []
+    occupied = {}  # (rack index, slot) -> tag
+    free = [(r, s) for r in range(racks) for s in range(slots)]
+    t = 0.0
+    tag_no = 0
+    for _ in range(events):
+        if free and (not occupied or rng.random() < 0.5 or len(occupied) < racks * slots // 2):
+            rack, slot = free.pop(rng.randrange(len(free)))
+            tag_no += 1
+            tag = f"{tag_no:010d}"
+            script.append((t, "RFID", tag))
+            script.append((t + scan_lead, f"rack{rack + 1}_sensor", f"{int((t + scan_lead) * 1000)} SLOT_{slot}:PRESENT"))
+            occupied[(rack, slot)] = tag
+        else:
+            rack, slot = rng.choice(sorted(occupied))
+            del occupied[(rack, slot)]
+            script.append((t, f"rack{rack + 1}_sensor", f"{int(t * 1000)} SLOT_{slot}:REMOVED"))
+            free.append((rack, slot))
+        t += gap
+    return script
+
+
+def load_script(path):
+    script = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            t, source, payload = line.split(None, 2)
+            script.append((float(t), source, payload))
+    return sorted(script, key=lambda e: e[0])
+
+
+def save_script(script, path):
+    with open(path, "w") as f:
+        for t, source, payload in script:
+            f.write(f"{t:.3f} {source} {payload}\n")
+
+
+def manifest_for(racks, slots, ports):
+    """One LED board and one sensor board per rack, each port a pty."""
+    return {"racks": [{
+        "name": f"rack{r + 1}",
+        "slots": slots,
+        "positions": [3 + 8 * s for s in range(slots)],
+        "ports": [
+            {"id": f"rack{r + 1}_led", "port": ports[f"rack{r + 1}_led"], "role": "led"},
+            {"id": f"rack{r + 1}_sensor", "port": ports[f"rack{r + 1}_sensor"], "role": "sensor"},
+        ],
+    } for r in range(racks)]}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+class Simulation:
+    def __init__(self, racks=1, slots=7, latency=0.0, min_time=60, workdir=None, fleet=None):
+        self.workdir = workdir or tempfile.mkdtemp(prefix="battery-sim-")
+        self.masters = {}  # port id -> master fd (our end of the pty)
+        self._slaves = []  # kept open so the pty doesn't hang up between reconnects
+        ports = {}
+        for r in range(racks):
+            for kind in ("led", "sensor"):
+                master, slave = pty.openpty()
+                tty.setraw(slave)  # no echo, no \n -> \r\n, like a real serial port
+                port_id = f"rack{r + 1}_{kind}"
+                self.masters[port_id] = master
+                self._slaves.append(slave)
+                ports[port_id] = os.ttyname(slave)
+        with open(os.path.join(self.workdir, "hardwareIDS.json"), "w") as f:
+            json.dump(manifest_for(racks, slots, ports), f, indent=2)
+
+        data = dict(fleet or {}, Settings={"minTime": min_time}) # fleet is {"BatteryList": ...} from export.load_export()
+        self.db = FakeDatabase(data, latency=latency)
+        self.led_frames = 0
+        self.sent = []  # (time written, port id, payload)
+
+        # input_listener reads hardwareIDS.json and opens its journal/log relative to the working directory
+        os.chdir(self.workdir)
+        os.environ.setdefault("LOG_LEVEL", "WARNING")  # the per-line INFO logs would drown the results
+        if REPO_DIR not in sys.path:
+            sys.path.insert(0, REPO_DIR)
+        import input_listener
+        self.il = input_listener
+        self.il.setup()
+        self.il.open_serial_port = FdSerial
+        self.il.ARDUINO_BOOT_SECONDS = 0  # nothing to reset on a pty
+        self.il.METRICS_PORT = 0  # dont fight a real listener on this machine for the port
+        self.il.API_PORT = 0
+        self.racks = {rack.name: rack for rack in self.il.RACKS}
+        self.port_rack = {rp.id: rack for rack, rp in self.il.RACK_PORTS}
+
+    def _start_led_boards(self, loop):
+        # answer "F 12:0,3,0,S 13:..." frames with "ACK 12 13" and legacy SEG lines with a bare ACK
+        for port_id, master in self.masters.items():
+            if not port_id.endswith("_led"):
+                continue
+            framer = LineFramer()
+
+            def readable(master=master, framer=framer):
+                try:
+                    data = os.read(master, 4096)
+                except OSError:
+                    return
+                for line in framer.feed(data):
+                    if line.startswith(b"F "):
+                        self.led_frames += 1
+                        seqs = [tok.split(b":", 1)[0] for tok in line[2:].split()]
+                        os.write(master, b"ACK " + b" ".join(seqs) + b"\n")
+                    elif line.startswith(b"SEG "):
+                        self.led_frames += 1
+                        os.write(master, b"ACK\n")
+            loop.add_reader(master, readable)
+
+    async def run(self, script, speed=1.0, timeout=30.0):
+        """Play the script, wait for firebase to catch up, return the results dict."""
+        loop = asyncio.get_running_loop()
+        rfid_r, rfid_w = os.pipe()
+        self._start_led_boards(loop)
+        tasks = await self.il.start_tasks(rfid_source=open(rfid_r, "rb", buffering=0), database=self.db)
+
+        # wait for every port to be opened by handle_serial
+        await asyncio.wait_for(asyncio.gather(*(ev.wait() for ev in self.il.port_connected.values())), timeout)
+        self.db.reset_counters()
+
+        expected = {"start": 0, "stop": 0}
+        filled = set()
+        started = time.monotonic()
+        for t, source, payload in script:
+            delay = started + t / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if source == "RFID":
+                os.write(rfid_w, payload.encode() + b"\n")
+                continue
+            os.write(self.masters[source], payload.encode() + b"\n")
+            self.sent.append((time.time(), source, payload))
+            rack = self.port_rack[source]
+            parsed = self.il.parse_slot_line(payload.encode())
+            if parsed:
+                key = (rack.name, parsed[0])
+                if parsed[1] == "PRESENT":
+                    expected["start"] += 1
+                    filled.add(key)
+                elif key in filled:
+                    expected["stop"] += 1
+                    filled.discard(key)
+        script_done = time.monotonic()
+
+        # wait until every start/stop made it to the fake database (or give up)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            commits = self._commits()
+            if (sum(1 for c in commits if c[1] == "start") >= expected["start"]
+                    and sum(1 for c in commits if c[1] == "stop") >= expected["stop"]
+                    and self.il.journal.pending_count() == 0):
+                break
+            await asyncio.sleep(0.02)
+        finished = time.monotonic()
+
+        await self.il.stop_tasks(tasks)
+        os.close(rfid_w)
+        return self._results(script, expected, finished - started, script_done - started)
+
+    def _commits(self):
+        """[(commit time, "start"/"stop", station slot, tag)] from the fake database's write log."""
+        commits = []
+        for t, method, path, data in list(self.db.write_log):
+            if method != "update" or not isinstance(data, dict):
+                continue
+            for key, value in data.items():
+                parts = key.split("/")
+                if len(parts) == 3 and parts[0] == "BatteryList" and parts[2] == "IsCharging":
+                    tag = parts[1]
+                    if value:
+                        commits.append((t, "start", data.get(f"BatteryList/{tag}/ChargingSlot"), tag))
+                    else:
+                        commits.append((t, "stop", data.get(f"BatteryList/{tag}/LastChargingSlot"), tag))
+        return commits
+
+    def _results(self, script, expected, elapsed, script_time):
+        # insert-to-commit latency: the n-th PRESENT (REMOVED) written for a slot pairs with the n-th start (stop) committed for it
+        written = {}
+        for t, source, payload in self.sent:
+            parsed = self.il.parse_slot_line(payload.encode())
+            if parsed:
+                slot = self.port_rack[source].global_slot(parsed[0])
+                written.setdefault(("start" if parsed[1] == "PRESENT" else "stop", slot), []).append(t)
+        latencies = {"start": [], "stop": []}
+        commits = self._commits()
+        for t, kind, slot, tag in commits:
+            pending = written.get((kind, slot))
+            if pending:
+                latencies[kind].append(t - pending.pop(0))
+
+        committed = len(commits)
+        commit_span = commits[-1][0] - commits[0][0] if committed > 1 else 0.0
+        calls = dict(self.db.calls)
+        all_latencies = latencies["start"] + latencies["stop"]
+        ms = lambda v: None if v is None else round(v * 1000, 2)  # noqa: E731
+        return {
+            "slot_events": len(self.sent),
+            "committed": committed,
+            "expected": expected["start"] + expected["stop"],
+            "elapsed_s": round(elapsed, 3),
+            "script_s": round(script_time, 3),
+            "events_per_sec": round(committed / elapsed, 1) if elapsed else None,
+            # first to last commit. with a paced script this is just the pacing, play it with a huge --speed to measure throughput
+            "commit_rate": round((committed - 1) / commit_span, 1) if commit_span else None,
+            "latency_ms": {
+                "p50": ms(percentile(all_latencies, 50)),
+                "p95": ms(percentile(all_latencies, 95)),
+                "p99": ms(percentile(all_latencies, 99)),
+                "max": ms(max(all_latencies) if all_latencies else None),
+                "start_p50": ms(percentile(latencies["start"], 50)),
+                "stop_p50": ms(percentile(latencies["stop"], 50)),
+            },
+            "firebase_calls": calls,
+            "firebase_calls_per_event": round(sum(v for k, v in calls.items() if k != "listen") / committed, 2) if committed else None,
+            "led_frames": self.led_frames,
+            "tag_matcher": self.il.pending_tags.stats(),
+            "metrics": self.il.metrics.REGISTRY.compact(),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate racks, RFID scans and firebase for input_listener.")
+    parser.add_argument("--events", type=int, default=200, help="synthetic slot events to generate")
+    parser.add_argument("--racks", type=int, default=1)
+    parser.add_argument("--slots", type=int, default=7, help="slots per rack")
+    parser.add_argument("--gap", type=float, default=0.05, help="seconds between synthetic events")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake firebase call")
+    parser.add_argument("--speed", type=float, default=1.0, help="play the script this many times faster than real time")
+    parser.add_argument("--replay", help="script file to play instead of a synthetic one")
+    parser.add_argument("--save", help="write the script that was played to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fleet", help="NDJSON export (export.py) to load into the fake database first")
+    parser.add_argument("--json", action="store_true", help="print the results as one JSON line")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        script = load_script(os.path.abspath(args.replay))
+    else:
+        script = synthetic_script(args.racks, args.slots, args.events, gap=args.gap, seed=args.seed)
+    if args.save:
+        save_script(script, os.path.abspath(args.save))
+
+    fleet = None
+    if args.fleet:
+        from export import load_export
+        fleet = load_export(os.path.abspath(args.fleet))
+    sim = Simulation(racks=args.racks, slots=args.slots, latency=args.latency, fleet=fleet)
+    results = asyncio.run(sim.run(script, speed=args.speed))
+    if args.json:
+        print(json.dumps(results, allow_nan=False), file=sys.__stdout__)  # same rule as the heartbeat, firebase rejects Infinity/NaN
+    else:
+        for key, value in results.items():
+            print(f"{key:>26}: {value}", file=sys.__stdout__)
+    return 0 if results["committed"] >= results["expected"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""Time-indexed matcher between RFID scans and slot insertions.
+
+pending_tags used to be a plain list scanned front to back for every PRESENT
+event. It only shrank when something matched, so stray scans piled up all
+shift, and the first scan inside the window won even if a closer one existed.
+
+Scans are kept sorted by time. Matching is a bisect to the slot time and a look
+at the neighbours on either side, so it stays O(log n) however many slots are
+being filled at once. Scans too old to ever match are expired from the front.
+
+wait_for_match_async() is the rendezvous between the RFID reader and the slot
+handler: it returns the moment a usable scan exists, or as soon as one arrives,
+instead of always sleeping a fixed second before looking. The end of the window
+is a timer on the caller's TimerWheel.
+"""
+import asyncio
+import bisect
+import threading
+import time
+
+
+class PendingTagMatcher:
+    def __init__(self, window, grace=5.0):
+        self.window = window  # a scan and an insert match if they are at most this many seconds apart
+        self.grace = grace    # keep scans this much longer than the window, slot events can be processed a little late
+        self._lock = threading.Lock()
+        self._times = []      # scan times, sorted
+        self._tags = []       # tag for each scan time
+        self._alive = []      # False once matched (removed lazily)
+        self._head = 0        # everything before this index is expired
+        self._dead = 0        # matched entries still in the lists
+        self._async_waiters = []  # (loop, future) for wait_for_match_async callers, woken by add()
+        self.counters = {"scanned": 0, "matched": 0, "expired": 0, "ambiguous": 0, "unmatched_slots": 0}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._times) - self._head - self._dead
+
+    def add(self, tag, t):
+        """Record a scan of `tag` at time t."""
+        with self._lock:
+            self._expire(t)
+            i = bisect.bisect_right(self._times, t, self._head)  # almost always the end, scans arrive in order
+            self._times.insert(i, t)
+            self._tags.insert(i, tag)
+            self._alive.insert(i, True)
+            self.counters["scanned"] += 1
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(_wake, fut)  # add() can be called from any thread
+
+    async def wait_for_match_async(self, slot_time, timers, clock=time.time):
+        """Take the scan closest in time to slot_time within the window, returns (tag, scan_time). If there is none yet,
+        wait for one until the window after slot_time closes (a timer on the TimerWheel `timers`) and return None
+        if it never comes."""
+        loop = asyncio.get_running_loop()
+        deadline = slot_time + self.window  # a scan after this could never match
+        while True:
+            with self._lock:
+                now = clock()
+                self._expire(min(now, deadline))  # dont let a late-processed event expire the scans it should match
+                result = self._take_closest(slot_time)
+                if result is not None:
+                    return result
+                if now >= deadline:
+                    self.counters["unmatched_slots"] += 1
+                    return None
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
+            timer = timers.call_later(deadline - now, "tag_match", _wake, waiter[1])
+            try:
+                await waiter[1]
+            finally:
+                timer.cancel()
+                with self._lock:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["pending"] = len(self._times) - self._head - self._dead
+        return stats
+
+    # --- internals (caller holds self._lock) ---
+
+    def _take_closest(self, slot_time):
+        times, alive = self._times, self._alive
+        i = bisect.bisect_left(times, slot_time, self._head)
+        best = None
+        candidates = 0
+        # walk outwards from the insertion point on both sides while still inside the window
+        j = i - 1
+        while j >= self._head and slot_time - times[j] <= self.window:
+            if alive[j]:
+                candidates += 1
+                if best is None or slot_time - times[j] < abs(times[best] - slot_time):
+                    best = j
+            j -= 1
+        j = i
+        while j < len(times) and times[j] - slot_time <= self.window:
+            if alive[j]:
+                candidates += 1
+                if best is None or times[j] - slot_time < abs(times[best] - slot_time):
+                    best = j
+            j += 1
+
+        if best is None:
+            return None
+        if candidates > 1:
+            self.counters["ambiguous"] += 1  # more than one scan could have been this battery, we took the closest
+        alive[best] = False
+        self._dead += 1
+        self.counters["matched"] += 1
+        result = (self._tags[best], times[best])
+        self._compact()
+        return result
+
+    def _expire(self, now):
+        horizon = now - self.window - self.grace
+        times, alive = self._times, self._alive
+        head = self._head
+        while head < len(times) and times[head] < horizon:
+            if alive[head]:
+                self.counters["expired"] += 1
+            else:
+                self._dead -= 1
+            head += 1
+        self._head = head
+        self._compact()
+
+    def _compact(self):
+        # drop the expired prefix and matched entries once they are the bulk of the lists, amortised O(1)
+        garbage = self._head + self._dead
+        if garbage < 64 or garbage * 2 < len(self._times):
+            return
+        keep = [i for i in range(self._head, len(self._times)) if self._alive[i]]
+        self._times = [self._times[i] for i in keep]
+        self._tags = [self._tags[i] for i in keep]
+        self._alive = [True] * len(keep)
+        self._head = 0
+        self._dead = 0
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
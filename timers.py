@@ -0,0 +1,165 @@
+"""One timer wheel for every sleep and timeout on the event loop.
+
+The LED manager, the LED senders, the heartbeat and the retry loops each used
+to keep their own cadence with sleeps and wait_for timeouts. They all go
+through TimerWheel now. Deadlines (monotonic seconds) are rounded up to the
+next `tick` and bucketed by tick number, so every timer that falls in the same
+tick fires on one wakeup, and the loop only ever has one timer handle of ours
+armed, for the earliest bucket. Timers never fire early and at most about a
+tick late.
+
+Every timer has a name. How late it fired goes into the `lateness` histogram
+and sleep_until_next() counts passes that overran their period in `overruns`,
+both labelled by name (anything with observe()/inc(), e.g. metrics.Histogram
+and metrics.Counter).
+"""
+import asyncio
+import heapq
+import math
+import time
+
+DEFAULT_TICK = 0.02  # seconds
+
+
+class Timer:
+    __slots__ = ("when", "name", "callback", "args", "tick", "_wheel")
+
+    def __init__(self, wheel, when, name, callback, args, tick):
+        self._wheel = wheel
+        self.when = when
+        self.name = name
+        self.callback = callback
+        self.args = args
+        self.tick = tick
+
+    def cancel(self):
+        if self._wheel is not None:
+            self._wheel._discard(self)
+            self._wheel = None
+
+
+class TimerWheel:
+    def __init__(self, tick=DEFAULT_TICK, lateness=None, overruns=None):
+        self.tick = tick
+        self.lateness = lateness
+        self.overruns = overruns
+        self.wakeups = 0   # times the loop woke up for us
+        self.fired = 0     # timers fired, more than wakeups when deadlines got coalesced
+        self._buckets = {} # tick number -> [Timer]
+        self._ticks = []   # heap of tick numbers, can hold ones whose bucket is gone
+        self._handle = None
+        self._armed_tick = None
+        self._loop = None
+
+    def call_at(self, when, name, callback, *args):
+        """Run callback(*args) on the loop at monotonic time `when` (or the end of its tick)."""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:  # first use, or a new loop (the simulator runs one per process, asyncio.run can make more)
+            self._loop = loop
+            self._buckets.clear()
+            self._ticks = []
+            self._handle = self._armed_tick = None
+        n = math.ceil(when / self.tick)
+        timer = Timer(self, when, name, callback, args, n)
+        bucket = self._buckets.get(n)
+        if bucket is None:
+            bucket = self._buckets[n] = []
+            heapq.heappush(self._ticks, n)
+        bucket.append(timer)
+        self._arm()
+        return timer
+
+    def call_later(self, delay, name, callback, *args):
+        return self.call_at(time.monotonic() + max(0.0, delay), name, callback, *args)
+
+    async def sleep(self, delay, name):
+        future = asyncio.get_running_loop().create_future()
+        timer = self.call_later(delay, name, _resolve, future, None)
+        try:
+            await future
+        finally:
+            timer.cancel()
+
+    async def sleep_until_next(self, name, started, interval):
+        """Sleep until `interval` after `started` (monotonic), for loops that run every interval.
+        A pass that already took longer than that counts as an overrun and does not sleep."""
+        if time.monotonic() - started >= interval:
+            if self.overruns is not None:
+                self.overruns.inc(timer=name)
+            await asyncio.sleep(0)  # still let everything else run
+            return
+        future = asyncio.get_running_loop().create_future()
+        timer = self.call_at(started + interval, name, _resolve, future, None)
+        try:
+            await future
+        finally:
+            timer.cancel()
+
+    async def wait(self, event, timeout, name):
+        """Wait for an asyncio.Event for up to timeout seconds (None = forever). Returns True if it got set."""
+        if event.is_set():
+            return True
+        if timeout is None:
+            await event.wait()
+            return True
+        waiter = asyncio.ensure_future(event.wait())
+        timer = self.call_later(timeout, name, waiter.cancel)
+        try:
+            await waiter
+            return True
+        except asyncio.CancelledError:
+            if timer._wheel is None and not asyncio.current_task().cancelling():  # our timer fired, not someone cancelling us
+                return False
+            raise
+        finally:
+            timer.cancel()
+            waiter.cancel()
+
+    # --- internals ---
+
+    def _discard(self, timer):
+        bucket = self._buckets.get(timer.tick)
+        if bucket is None:
+            return
+        try:
+            bucket.remove(timer)
+        except ValueError:
+            return
+        if not bucket:
+            del self._buckets[timer.tick]  # its heap entry is skipped by _arm
+            if timer.tick == self._armed_tick:
+                self._arm()
+
+    def _arm(self):
+        ticks = self._ticks
+        while ticks and ticks[0] not in self._buckets:
+            heapq.heappop(ticks)
+        first = ticks[0] if ticks else None
+        if first == self._armed_tick:
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._armed_tick = first
+        if first is not None:
+            self._handle = self._loop.call_later(max(0.0, first * self.tick - time.monotonic()), self._run)
+
+    def _run(self):
+        self._handle = self._armed_tick = None
+        self.wakeups += 1
+        now = time.monotonic()
+        due = math.floor(now / self.tick + 1e-9)
+        while self._ticks and self._ticks[0] <= due:
+            bucket = self._buckets.pop(heapq.heappop(self._ticks), None)
+            for timer in bucket or ():
+                timer._wheel = None  # fired, cancel() is a no-op from here
+                self.fired += 1
+                if self.lateness is not None:
+                    self.lateness.observe(max(0.0, now - timer.when), timer=timer.name)
+                timer.callback(*timer.args)
+        self._arm()
+
+
+def _resolve(future, value):
+    if not future.done():
+        future.set_result(value)
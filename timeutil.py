@@ -0,0 +1,61 @@
+"""Timestamp formatting/parsing for the "%Y-%m-%d %H:%M:%S" strings Firebase has always stored.
+
+Formatting goes through time.localtime and a cached string for the current
+second instead of datetime.fromtimestamp().strftime(). Parsing slices the fixed
+width fields instead of strptime and is memoised, the same few ChargingStartTime
+strings get looked at over and over. New data also carries epoch seconds next to
+the strings, so durations are a subtraction and stay right across DST changes.
+"""
+import time
+from functools import lru_cache
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_last_second = None
+_last_string = None
+
+
+def format_timestamp(ts=None):
+    """Epoch seconds (default now) -> "YYYY-MM-DD HH:MM:SS" local time."""
+    global _last_second, _last_string
+    second = int(time.time() if ts is None else ts)
+    if second == _last_second:
+        return _last_string
+    tm = time.localtime(second)
+    text = "%04d-%02d-%02d %02d:%02d:%02d" % (tm.tm_year, tm.tm_mon, tm.tm_mday, tm.tm_hour, tm.tm_min, tm.tm_sec)
+    _last_second, _last_string = second, text  # one tuple swap, safe to race
+    return text
+
+
+@lru_cache(maxsize=1024)
+def parse_timestamp(ts_str):
+    """"YYYY-MM-DD HH:MM:SS" local time -> epoch seconds, or None if it isn't one."""
+    if not isinstance(ts_str, str) or len(ts_str) != 19 or ts_str[4] != "-" or ts_str[10] != " ":
+        return None
+    try:
+        fields = (int(ts_str[0:4]), int(ts_str[5:7]), int(ts_str[8:10]),
+                  int(ts_str[11:13]), int(ts_str[14:16]), int(ts_str[17:19]))
+    except ValueError:
+        return None
+    if not (1 <= fields[1] <= 12 and 1 <= fields[2] <= 31 and fields[3] < 24 and fields[4] < 60 and fields[5] < 62):
+        return None
+    try:
+        return time.mktime(fields + (0, 0, -1))  # -1 lets mktime work out whether DST applied at that moment
+    except (OverflowError, ValueError):
+        return None
+
+
+def format_duration(seconds):
+    """Whole seconds as the string Firebase stores in Duration/LastOverallChargeTime, rounded down.
+
+    Replaces str(timedelta.total_seconds())[:-2], which only worked while the
+    value happened to end in ".0" (30.25 came out as "30.").
+    """
+    return str(max(0, int(seconds)))
+
+
+def epoch_or_parse(epoch, ts_str):
+    """Prefer a stored epoch value, fall back to parsing the legacy string."""
+    if isinstance(epoch, (int, float)):
+        return float(epoch)
+    return parse_timestamp(ts_str) if ts_str else None